@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# Benchmark: PackBits decoding of BITD-like data, old per-byte loop vs.
+# shockabsorber.loader.packbits (pure Python, and compiled if built).
+# Also checks that all decoders agree, including on truncated input.
+
+import random
+import struct
+import time
+from shockabsorber.loader import packbits
+from shockabsorber.loader.util import SeqBuffer
+
+def legacy_unpack(blob, limit=None):
+    # The decoding loop BITDMedia/ThumMedia used before packbits.py.
+    buf = SeqBuffer(blob)
+    res = bytearray()
+    while (limit==None or len(res) < limit) and not buf.at_eof():
+        [d] = buf.unpack('b')
+        if d < 0:
+            run_length = 1-d
+            v = buf.readBytes(1).tobytes()
+            res.extend(v*run_length)
+        else:
+            lit_length = 1+d
+            res.extend(buf.readBytes(lit_length))
+    return bytes(res)
+
+def pack(data):
+    data = bytearray(data)
+    out = bytearray()
+    i = 0
+    while i < len(data):
+        j = i
+        while j < len(data) and j-i < 128 and data[j] == data[i]: j += 1
+        if j-i >= 2:
+            out += struct.pack('bB', 1-(j-i), data[i])
+            i = j
+        else:
+            k = i+1
+            while k < len(data) and k-i < 128 and data[k] != data[k-1]: k += 1
+            out += struct.pack('b', k-i-1) + data[i:k]
+            i = k
+    return bytes(out)
+
+def make_image(width, height, planes, seed=1):
+    # Planar rows with a mix of flat areas and noise, like real artwork.
+    rnd = random.Random(seed)
+    rows = []
+    for y in range(height*planes):
+        row = bytearray()
+        while len(row) < width:
+            n = rnd.randint(1, 200)
+            if rnd.random() < 0.5:
+                row += bytearray([rnd.randint(0, 255)]) * n
+            else:
+                row += bytearray(rnd.randint(0, 255) for _ in range(n))
+        rows.append(bytes(row[:width]))
+    return b''.join(rows)
+
+def timed(fn, *args):
+    t0 = time.time()
+    res = fn(*args)
+    return res, time.time() - t0
+
+def main():
+    width, height, planes = 1024, 768, 4
+    raw = make_image(width, height, planes)
+    blob = pack(raw)
+    print("Image: %dx%dx%d bits, %d bytes packed to %d" % (width, height, 8*planes, len(raw), len(blob)))
+
+    decoders = [("legacy loop", legacy_unpack),
+                ("packbits.unpack_py", lambda b: packbits.unpack_py(b, None, len(raw)))]
+    if packbits._accel_unpack != None:
+        decoders.append(("packbits_accel", lambda b: packbits.unpack(b, None, len(raw))))
+    else:
+        print("(packbits_accel not built; 'make packbits_accel.so' to include it)")
+
+    base = None
+    for name, fn in decoders:
+        res, t = timed(fn, memoryview(blob))
+        assert res == raw, name
+        if base == None: base = t
+        print("%-20s %8.3f s  %7.1f MB/s  x%.1f" % (name, t, len(raw)/t/1e6, base/t))
+
+    # Truncated and limited input must decode exactly like the old loop:
+    rnd = random.Random(2)
+    small = blob[:20000]
+    for cut in [0, 1, 2, 3] + [rnd.randint(0, len(small)) for _ in range(200)]:
+        for limit in [None, 0, 1, 100, 5000]:
+            expected = legacy_unpack(small[:cut], limit)
+            assert packbits.unpack_py(small[:cut], limit) == expected, (cut, limit)
+            assert packbits.unpack_py(small[:cut], limit, 64) == expected, (cut, limit)
+            assert packbits.unpack(small[:cut], limit) == expected, (cut, limit)
+    print("Truncated input: all decoders agree.")
+
+if __name__ == '__main__':
+    main()
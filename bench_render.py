@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# Benchmark: sequential playback through shockabsorber.render.compositor,
+# redrawing the whole stage each frame vs. IncrementalRenderer, which
+# redraws only where channels changed. Also checks that both give the
+# same frames.
+
+import random
+import struct
+import sys
+import time
+from shockabsorber.loader.loader import ImageCastType
+from shockabsorber.model.cast import CastLibraryTable, CastLibrary
+from shockabsorber.model.frames import FrameSequence, FrameDelta, FrameDeltaItem
+from shockabsorber.render.compositor import Compositor, IncrementalRenderer
+
+STAGE_SIZE = (1024, 768)
+SPRITE_COUNT = 80
+SPRITE_SIZE = 48
+MEMBER_COUNT = 10
+
+class BenchMedia:
+    def __init__(self, decoded): self.decoded = decoded
+
+class BenchMember:
+    def __init__(self, width, height, anchor, pixels):
+        self.type = 1
+        self.castdata = ImageCastType((width, height), (width, height), anchor, 8, 0, None)
+        self.media = {b'BITD': BenchMedia(pixels)}
+
+def make_castlibs(rnd):
+    (W, H) = STAGE_SIZE
+    members = [BenchMember(W, H, (W//2, H//2), bytes(bytearray(W*H)))] # The background.
+    for nr in range(1, MEMBER_COUNT):
+        (w, h) = (rnd.randint(16, 160), rnd.randint(16, 160))
+        pixels = bytes(bytearray(rnd.choice([0, rnd.randint(1, 255)]) for _ in range(w*h)))
+        members.append(BenchMember(w, h, (w//2, h//2), pixels))
+    castlib = CastLibrary(1, None, None, 0, None, 1024)
+    castlib.set_castmember_table(members)
+    return CastLibraryTable([castlib])
+
+def make_frames(rnd, frame_count):
+    # A background filling the stage in channel 0, a few dozen sprites
+    # in place, and a handful which move or change each frame.
+    def sprite(member, x, y, ink):
+        return struct.pack('>16h', ink, 0, 1, member, 0, 1, y, x, 0, 0, 0, 0, 0, 0, 0, 0) + b'\0'*16
+    (W, H) = STAGE_SIZE
+    first = [FrameDeltaItem(0, sprite(1, W//2, H//2, 0))]
+    for snr in range(1, SPRITE_COUNT//2):
+        first.append(FrameDeltaItem(snr*SPRITE_SIZE, sprite(rnd.randint(2, MEMBER_COUNT),
+                                                             rnd.randint(0, W), rnd.randint(0, H),
+                                                             rnd.choice([0, 8, 36]))))
+    deltas = [FrameDelta(first)]
+    for fnr in range(1, frame_count):
+        items = []
+        for _ in range(rnd.randint(1, 4)):
+            snr = rnd.randint(1, SPRITE_COUNT-1)
+            items.append(FrameDeltaItem(snr*SPRITE_SIZE, sprite(rnd.randint(2, MEMBER_COUNT),
+                                                                rnd.randint(0, W), rnd.randint(0, H),
+                                                                rnd.choice([0, 8, 36]))))
+        deltas.append(FrameDelta(items))
+    return FrameSequence(SPRITE_COUNT, SPRITE_SIZE, deltas, [None]*frame_count)
+
+def main():
+    frame_count = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+    rnd = random.Random(1)
+    castlibs = make_castlibs(rnd)
+    frame_seq = make_frames(rnd, frame_count)
+    compositor = Compositor(castlibs, STAGE_SIZE)
+    print("Stage %dx%d, %d channels, %d frames" % (STAGE_SIZE + (SPRITE_COUNT, frame_count)))
+
+    cursor = frame_seq.create_cursor()
+    frame_buffer = compositor.new_frame_buffer()
+    compositor.render(cursor, frame_buffer) # Decode the bitmaps up front.
+    t0 = time.time()
+    for fnr in range(1, frame_count+1):
+        cursor.go_to_frame(fnr)
+        compositor.render(cursor, frame_buffer)
+    t_full = time.time() - t0
+
+    renderer = IncrementalRenderer(compositor, frame_seq)
+    t0 = time.time()
+    for fnr in range(1, frame_count+1):
+        renderer.go_to_frame(fnr)
+    t_incremental = time.time() - t0
+
+    print("%-22s %8.1f frames/s" % ("full redraw", frame_count/t_full))
+    print("%-22s %8.1f frames/s  x%.1f  mean %.1f%% of the stage redrawn" % (
+        "IncrementalRenderer", frame_count/t_incremental, t_full/t_incremental,
+        100*renderer.mean_redrawn_fraction()))
+    assert renderer.frame_buffer == frame_buffer
+    for fnr in [frame_count//3, 1, frame_count]:
+        renderer.go_to_frame(fnr)
+        cursor.go_to_frame(fnr)
+        assert renderer.frame_buffer == compositor.render(cursor), fnr
+    print("Both give the same frames.")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+# Benchmark: conversion of decoded bitmap data to RGB(A) pixels, the old
+# per-pixel loops vs. shockabsorber.loader.rle's *_pixels converters
+# (with NumPy if installed, and without). Also checks that they agree.
+
+import random
+import time
+from shockabsorber.loader import rle
+
+scale = rle.scale_table_31_to_255
+
+def legacy_8bit(width, height, fullwidth, data, clut):
+    color_data = b""
+    for c in data:
+        nr = c*3
+        color_data += clut[nr:nr+3]
+    return color_data # Rows of fullwidth pixels.
+
+def legacy_16bit(width, height, fullwidth, data):
+    color_res = bytearray(3*width*height)
+    pos = 0
+    for y in range(height):
+        row_start = y*fullwidth
+        for x in range(width):
+            pix_start = row_start + x
+            bits = (data[pix_start] << 8) | data[pix_start + width]
+            a = bits >> 15
+            r = (bits >> 10) & 31
+            g = (bits >> 5) & 31
+            b = bits & 31
+            if a>0: r=31; g=31; b=0
+            color_res[pos]   = scale[r]
+            color_res[pos+1] = scale[g]
+            color_res[pos+2] = scale[b]
+            pos += 3
+    return bytes(color_res)
+
+def legacy_32bit(width, height, fullwidth, data):
+    color_res = bytearray(4*width*height)
+    pos = 0
+    for y in range(height):
+        for x in range(width):
+            for c in range(4):
+                color_res[pos+c] = data[y*fullwidth + x + c*width]
+            pos += 4
+    return bytes(color_res)
+
+def legacy_32bit_masked(width, height, fullwidth, width2,height2,fullwidth2, data, mask):
+    color_res = bytearray(4*width*height)
+    pos = 0
+    for y in range(height):
+        for x in range(width):
+            for c in range(3):
+                color_res[pos+c] = data[y*fullwidth + x + c*width]
+            pos += 4
+    for y in range(min(height,height2)):
+        pos = y*4*width
+        for x in range(min(width,width2)):
+            color_res[pos+3] = mask[y*fullwidth2 + x]
+            pos += 4
+    return bytes(color_res)
+
+def bit_iterator(data):
+    for c in data:
+        for i in range(7,-1,-1):
+            yield (c>>i)&1
+
+def legacy_bpp_iterator(data, width, fullwidth, bpp):
+    while data:
+        no = b = 0
+        yc = 0
+        for bit in bit_iterator(data[:fullwidth]):
+            b=b<<1|bit
+            no += 1
+            if no != bpp: continue
+
+            yield b
+            b = 0
+            no = 0
+            yc += 1
+            if yc == width:
+                break
+        data = data[fullwidth:]
+
+def crop_rows(pixels, width, fullwidth, height, channels):
+    return b''.join(pixels[y*fullwidth*channels : (y*fullwidth+width)*channels] for y in range(height))
+
+def random_bytes(rnd, n):
+    return bytearray(rnd.getrandbits(8) for _ in range(n))
+
+def timed(fn, *args):
+    t0 = time.time()
+    res = fn(*args)
+    return res, time.time() - t0
+
+def run(name, width, height, legacy, new, check=lambda res: res):
+    base = None
+    for impl_name, fn in [("legacy loop", legacy), ("rle", new)]:
+        res, t = timed(fn)
+        if base == None:
+            base = t; expected = check(res)
+        else:
+            assert res == expected, name
+        print("%-18s %-12s %8.3f s  %7.2f Mpixel/s  x%.1f" % (name, impl_name, t, width*height/t/1e6, base/t))
+
+def main():
+    rnd = random.Random(1)
+    print("NumPy: %s" % ("yes" if rle.numpy != None else "no"))
+    w, h = 320, 240 # The old 8-bit loop is quadratic; keep this one small.
+    fw = w + 2
+    data = random_bytes(rnd, fw*h)
+    run("8 bit, palette", w, h,
+        lambda: legacy_8bit(w, h, fw, data, rle.clut),
+        lambda: rle.rgb_pixels_8bit(w, h, fw, data, rle.clut),
+        lambda res: crop_rows(res, w, fw, h, 3))
+
+    w, h = 800, 600
+    for bpp in (1, 2, 4):
+        fw = ((w-3)*bpp + 7) // 8 + 2 # Padded rows, and a width not filling the last byte.
+        data = random_bytes(rnd, fw*h)
+        run("%d bit, indices" % bpp, w-3, h,
+            lambda: bytes(bytearray(legacy_bpp_iterator(data, w-3, fw, bpp))),
+            lambda: rle.expand_indexes(w-3, h, fw, data, bpp))
+
+    fw = 2*w + 2
+    data = random_bytes(rnd, fw*h)
+    run("16 bit, 5-5-5", w, h,
+        lambda: legacy_16bit(w, h, fw, data),
+        lambda: rle.rgb_pixels_16bit(w, h, fw, data))
+
+    fw = 4*w
+    data = random_bytes(rnd, fw*h)
+    run("32 bit", w, h,
+        lambda: legacy_32bit(w, h, fw, data),
+        lambda: rle.rgba_pixels_32bit(w, h, fw, data))
+
+    mw, mh = w - 10, h + 10
+    mask = random_bytes(rnd, mw*mh)
+    run("32 bit + mask", w, h,
+        lambda: legacy_32bit_masked(w, h, fw, mw, mh, mw, data, mask),
+        lambda: rle.rgba_pixels_32bit_masked(w, h, fw, mw, mh, mw, data, mask))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# Benchmark: memory use and replay speed of the score frame delta
+# storage, FrameDelta objects vs. shockabsorber.model.frames'
+# PackedFrameDeltaTable. Also checks that both give the same sprite vectors.
+
+import random
+import struct
+import sys
+import time
+from shockabsorber.loader import score_parser
+from shockabsorber.model.frames import FrameSequence, FrameDeltaList
+
+SPRITE_COUNT = 150
+SPRITE_SIZE = 48
+
+def make_score_entry(frame_count, seed=1):
+    # Score root primary entry: each frame changes a few sprites, some
+    # of them wholesale, most of them in a field or two.
+    rnd = random.Random(seed)
+    frames = []
+    for fnr in range(frame_count):
+        items = b''
+        for _ in range(rnd.randint(0, 12)):
+            channel = rnd.randint(0, SPRITE_COUNT-1)
+            if rnd.random() < 0.2:
+                start, length = 0, SPRITE_SIZE
+            else:
+                start, length = 2*rnd.randint(0, 20), 2*rnd.randint(1, 4)
+            payload = bytes(bytearray(rnd.randint(0, 255) for _ in range(length)))
+            items += struct.pack('>HH', length, channel*SPRITE_SIZE+start) + payload
+        frames.append(struct.pack('>H', len(items)+2) + items)
+    data = b''.join(frames)
+    header = struct.pack('>3i4h', 20+len(data), 0, frame_count, 0, SPRITE_SIZE, 0, SPRITE_COUNT-6)
+    return header + data
+
+def deep_size(obj, seen=None):
+    if seen == None: seen = set()
+    if id(obj) in seen: return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, (list, tuple)):
+        size += sum(deep_size(x, seen) for x in obj)
+    elif isinstance(obj, memoryview):
+        pass # A view; the buffers viewed are counted by the caller.
+    elif hasattr(obj, '__dict__'):
+        size += deep_size(obj.__dict__, seen)
+    elif isinstance(obj, dict):
+        size += sum(deep_size(k, seen) + deep_size(v, seen) for k, v in obj.items())
+    return size
+
+def replay(frame_seq, repeat=5):
+    # Best of a few runs, as single runs are noisy.
+    best = None
+    for _ in range(repeat):
+        vector = bytearray(SPRITE_COUNT*SPRITE_SIZE)
+        t0 = time.time()
+        for fnr in range(frame_seq.frame_count()):
+            frame_seq.apply_delta_to(fnr, vector)
+        t = time.time() - t0
+        if best == None or t < best: best = t
+    return bytes(vector), best
+
+def main():
+    frame_count = 20000
+    entry = memoryview(make_score_entry(frame_count))
+    print("Score: %d frames, %d bytes of frame data" % (frame_count, len(entry)))
+
+    t0 = time.time()
+    (_, _, lazy) = score_parser.parse_score_entry_nr0(entry)
+    objects = FrameDeltaList(list(lazy))
+    t_objects = time.time() - t0
+    t0 = time.time()
+    (_, _, packed) = score_parser.parse_score_entry_nr0(entry, packed=True)
+    t_packed = time.time() - t0
+
+    results = []
+    replay_times = []
+    # The items of the objects view the score section, which they keep alive;
+    # the packed table holds a buffer of its own.
+    for name, deltas, buffer_size, t_load in [
+            ("FrameDelta objects", objects, len(entry), t_objects),
+            ("PackedFrameDeltaTable", packed, len(packed.data), t_packed)]:
+        frame_seq = FrameSequence(SPRITE_COUNT, SPRITE_SIZE, deltas, [], snapshot_interval=frame_count)
+        vector, t_replay = replay(frame_seq)
+        results.append(vector)
+        replay_times.append(t_replay)
+        print("%-22s %10d bytes  decode %.3f s  replay %.3f s" % (
+            name, deep_size(deltas) + buffer_size, t_load, t_replay))
+    assert results[0] == results[1]
+    ratio = replay_times[1] / replay_times[0]
+    print("Replay from the packed table takes x%.2f the time (%s than from the objects)." % (
+        ratio, "slower" if ratio > 1 else "faster"))
+    for fnr in [0, 1, frame_count//2, frame_count-1]:
+        assert [(i.start, i.bytes.tobytes()) for i in objects[fnr].items] == \
+               [(i.start, i.bytes.tobytes()) for i in packed[fnr].items], fnr
+    print("Both give the same sprite vectors.")
+
+if __name__ == '__main__':
+    main()
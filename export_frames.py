@@ -0,0 +1,6 @@
+#!/usr/bin/env python
+
+from shockabsorber.main import export_main
+
+if __name__ == '__main__':
+    export_main()
@@ -0,0 +1,95 @@
+/* Optional compiled PackBits decoder; see shockabsorber/loader/packbits.py.
+ * unpack(data, limit, size_hint) -> bytes, where limit < 0 means no limit.
+ * Builds for Python 2 and 3 ("make packbits_accel.so").
+ */
+#define PY_SSIZE_T_CLEAN
+#include <Python.h>
+#include <string.h>
+
+static int reserve(char **out, Py_ssize_t *cap, Py_ssize_t need)
+{
+    Py_ssize_t new_cap;
+    char *p;
+    if (need <= *cap) return 0;
+    new_cap = *cap * 2;
+    if (new_cap < need) new_cap = need;
+    p = PyMem_Realloc(*out, new_cap);
+    if (p == NULL) return -1;
+    *out = p;
+    *cap = new_cap;
+    return 0;
+}
+
+static PyObject *packbits_unpack(PyObject *self, PyObject *args)
+{
+    Py_buffer src;
+    Py_ssize_t limit = -1, size_hint = 0;
+    const unsigned char *in;
+    Py_ssize_t n, i = 0, pos = 0, cap;
+    char *out;
+    PyObject *res;
+
+    if (!PyArg_ParseTuple(args, "s*|nn:unpack", &src, &limit, &size_hint))
+        return NULL;
+    in = (const unsigned char *) src.buf;
+    n = src.len;
+    cap = size_hint > 0 ? size_hint : 2*n + 16;
+    out = PyMem_Malloc(cap);
+    if (out == NULL) {
+        PyBuffer_Release(&src);
+        return PyErr_NoMemory();
+    }
+
+    while (i < n) {
+        int d;
+        Py_ssize_t len;
+        if (limit >= 0 && pos >= limit) break;
+        d = (signed char) in[i++];
+        if (d < 0) { /* Run */
+            if (i >= n) break; /* Truncated: nothing to repeat. */
+            len = 1 - d;
+            if (reserve(&out, &cap, pos + len) < 0) goto nomem;
+            memset(out + pos, in[i], len);
+            i++;
+        } else { /* Literal */
+            len = d + 1;
+            if (len > n - i) len = n - i;
+            if (reserve(&out, &cap, pos + len) < 0) goto nomem;
+            memcpy(out + pos, in + i, len);
+            i += len;
+        }
+        pos += len;
+    }
+
+    PyBuffer_Release(&src);
+    res = PyBytes_FromStringAndSize(out, pos);
+    PyMem_Free(out);
+    return res;
+
+nomem:
+    PyBuffer_Release(&src);
+    PyMem_Free(out);
+    return PyErr_NoMemory();
+}
+
+static PyMethodDef packbits_methods[] = {
+    {"unpack", packbits_unpack, METH_VARARGS,
+     "unpack(data, limit=-1, size_hint=0) -> bytes"},
+    {NULL, NULL, 0, NULL}
+};
+
+#if PY_MAJOR_VERSION >= 3
+static struct PyModuleDef packbits_module = {
+    PyModuleDef_HEAD_INIT, "packbits_accel", NULL, -1, packbits_methods
+};
+
+PyMODINIT_FUNC PyInit_packbits_accel(void)
+{
+    return PyModule_Create(&packbits_module);
+}
+#else
+PyMODINIT_FUNC initpackbits_accel(void)
+{
+    Py_InitModule("packbits_accel", packbits_methods);
+}
+#endif
@@ -0,0 +1,139 @@
+#### Purpose:
+# Batched drawing of score frames with pyglet: the images of cast
+# members are packed into a few large textures, and a frame is drawn
+# as one pyglet Batch of textured quads.
+#
+
+import pyglet
+import pyglet.graphics
+import pyglet.image.atlas
+import pyglet.sprite
+from pyglet.gl import GL_QUADS, GL_SRC_ALPHA, GL_ONE_MINUS_SRC_ALPHA
+from shockabsorber.loader.image_cache import COPY_INK
+
+class SpriteAtlas: #------------------------------
+    """Maps (member_ref, ink) to a region of one of a few large textures
+    (a pyglet TextureBin) holding the member's image, as decoded by the
+    image cache. Images larger than a texture get a texture of their own."""
+    def __init__(self, image_cache, texture_size=2048):
+        self.image_cache = image_cache
+        self.texture_size = texture_size
+        self.bin = pyglet.image.atlas.TextureBin(texture_size, texture_size)
+        self.regions = {}
+
+    def __repr__(self):
+        return "<SpriteAtlas %d images in %d textures>" % (len(self.regions), self.texture_count())
+
+    def get_region(self, member_ref, ink=COPY_INK):
+        """Returns the texture region of the member's image, or None if it
+        is not a bitmap."""
+        if ink not in self.image_cache.decoding_inks: ink = COPY_INK
+        key = (member_ref, ink)
+        if key in self.regions: return self.regions[key]
+        image = self.image_cache.get_image(member_ref, ink)
+        if image == None:
+            region = None
+        elif image.width > self.texture_size or image.height > self.texture_size:
+            region = image.get_texture()
+        else:
+            region = self.bin.add(image)
+        self.regions[key] = region
+        return region
+
+    def texture_count(self):
+        return len(self.bin.atlases)
+#--------------------------------------------------
+
+class FrameBatch: #------------------------------
+    """The sprites of a score frame, as textured quads in one pyglet Batch.
+
+    Channels are drawn in order: each run of consecutive channels whose
+    images share a texture is one vertex list, and one draw call.
+    go_to_frame() recomputes the quads of the changed channels only;
+    runs keeping their channels and texture are updated in place, the
+    others are replaced.
+    The sprites are placed by the compositor (see Compositor.member_rect)
+    on a stage of its size; pyglet's y axis points up.
+    """
+    def __init__(self, frame_seq, compositor, atlas, first_frame=1):
+        self.compositor = compositor
+        self.atlas = atlas
+        self.batch = pyglet.graphics.Batch()
+        self.quads = {}        # Channel -> (texture region, vertices)
+        self.vertex_lists = {} # (texture id, channels) -> vertex list
+        self.cursor = frame_seq.create_cursor(track_changes=True)
+        self.cursor.go_to_frame(first_frame)
+        self.update(range(frame_seq.sprite_count))
+
+    def __repr__(self):
+        return "<FrameBatch frame=%d sprites=%d draw_calls=%d>" % (
+            self.cursor.get_current_frame_nr(), len(self.quads), self.draw_call_count())
+
+    def go_to_frame(self, where):
+        change = self.cursor.go_to_frame(where)
+        if not change.is_empty(): self.update(change.channels)
+
+    def draw(self):
+        self.batch.draw()
+
+    def draw_call_count(self):
+        return len(self.vertex_lists)
+
+    def update(self, channels):
+        for snr in channels:
+            quad = self.channel_quad(self.cursor.get_sprite(snr))
+            if quad == None:
+                self.quads.pop(snr, None)
+            else:
+                self.quads[snr] = quad
+        self.update_runs(set(channels))
+
+    def channel_quad(self, sprite):
+        if sprite.interval_ref <= 0: return None
+        rect = self.compositor.member_rect(sprite.member_ref, sprite.get_pos())
+        if rect == None: return None
+        region = self.atlas.get_region(sprite.member_ref, sprite.ink)
+        if region == None: return None
+        (left, top, right, bottom) = rect
+        (y0, y1) = (self.compositor.height - bottom, self.compositor.height - top)
+        return (region, [left, y0, right, y0, right, y1, left, y1])
+
+    def update_runs(self, changed):
+        runs = []
+        for snr in sorted(self.quads):
+            texture_id = self.quads[snr][0].id
+            if runs and runs[-1][0] == texture_id:
+                runs[-1][1].append(snr)
+            else:
+                runs.append((texture_id, [snr]))
+
+        old_lists = self.vertex_lists
+        self.vertex_lists = {}
+        for (texture_id, snrs) in runs:
+            key = (texture_id, tuple(snrs))
+            vertex_list = old_lists.pop(key, None)
+            if vertex_list == None:
+                vertex_list = self.add_run(snrs)
+            else:
+                for (i, snr) in enumerate(snrs):
+                    if snr not in changed: continue
+                    (region, vertices) = self.quads[snr]
+                    vertex_list.vertices[8*i : 8*i+8] = vertices
+                    vertex_list.tex_coords[12*i : 12*i+12] = region.tex_coords
+            self.vertex_lists[key] = vertex_list
+        for vertex_list in old_lists.values():
+            vertex_list.delete()
+
+    def add_run(self, snrs):
+        vertices = []
+        tex_coords = []
+        for snr in snrs:
+            (region, quad_vertices) = self.quads[snr]
+            vertices.extend(quad_vertices)
+            tex_coords.extend(region.tex_coords)
+        # Ordered by first channel, so that the runs are drawn in channel order:
+        group = pyglet.sprite.SpriteGroup(self.quads[snrs[0]][0], GL_SRC_ALPHA, GL_ONE_MINUS_SRC_ALPHA,
+                                          pyglet.graphics.OrderedGroup(snrs[0]))
+        return self.batch.add(4*len(snrs), GL_QUADS, group,
+                              ('v2i/dynamic', vertices), ('t3f/dynamic', tex_coords))
+#--------------------------------------------------
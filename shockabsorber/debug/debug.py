@@ -1,6 +1,10 @@
 import pyglet
+import pyglet.graphics
+import pyglet.sprite
 import pyglet.text
-import shockabsorber.loader.rle
+from shockabsorber.loader.image_cache import ImageCache
+from shockabsorber.render.compositor import Compositor
+from shockabsorber.debug.atlas import SpriteAtlas, FrameBatch
 from pyglet.gl import *
 
 def print_castlibs(movie):
@@ -26,151 +30,123 @@ def print_spritevectors(movie):
             if scr_member is None: continue
             print("  -> Script %s: %s (%d)" % ((libnr,memnr), scr_member, extra))
 
-        for snr in range(frames.sprite_count):
+        for snr in cursor.get_sprite_records().occupied_channels():
             raw_sprite = cursor.get_raw_sprite(snr)
-            if raw_sprite != bytearray(len(raw_sprite)):
-                sprite = cursor.get_sprite(snr)
-                print("---- Sprite #%d:" % snr)
-                print("  raw=<%r>" % raw_sprite)
-                print("  %s" % sprite)
-                if sprite.interval_ref > 0:
-                    (castnr, membernr) = sprite.member_ref
-                    member = movie.castlibs.get_cast_member(castnr, membernr)
-                    print("  -> member: %s" % member)
-                    if sprite.ink == 9:
-                        member2 = movie.castlibs.get_cast_member(castnr, membernr+1)
-                        if member2 != None:
-                            print("  -> mask: %s" % (member2.name))
-
-def show_images(movie):
+            sprite = cursor.get_sprite(snr)
+            print("---- Sprite #%d:" % snr)
+            print("  raw=<%r>" % bytes(bytearray(raw_sprite)))
+            print("  %s" % sprite)
+            if sprite.interval_ref > 0:
+                (castnr, membernr) = sprite.member_ref
+                member = movie.castlibs.get_cast_member(castnr, membernr)
+                print("  -> member: %s" % member)
+                if sprite.ink == 9:
+                    member2 = movie.castlibs.get_cast_member(castnr, membernr+1)
+                    if member2 != None:
+                        print("  -> mask: %s" % (member2.name))
+    (snapshot_count, snapshot_bytes) = frames.snapshot_memory()
+    print("==== Seek snapshots: %d (every %d frames), %d bytes ====" % (
+        snapshot_count, frames.snapshot_interval, snapshot_bytes))
+
+def print_member_usage(movie):
+    frames = movie.frames
+    if frames==None: return
+    usage = frames.member_usage()
+    print("==== Member usage: %s ====" % (usage,))
+    used = usage.used_members()
+    for libnr,cl in movie.castlibs.iter_by_nr():
+        if cl.castmember_table==None: continue
+        for i,cm in enumerate(cl.castmember_table):
+            if cm==None: continue
+            member_ref = (libnr, i+1)
+            if member_ref in used:
+                print("Used %s: %s in %s" % (member_ref, cm.name, usage.spans_of_member(member_ref)))
+            else:
+                print("Unused %s: %s" % (member_ref, cm.name))
+
+def show_images(movie, image_cache=None):
+    if image_cache==None: image_cache = ImageCache(movie.castlibs)
+    W = 8000; H = 1200
+    window = pyglet.window.Window(width=W, height=H) # Before any texture is made.
+
+    atlas = SpriteAtlas(image_cache)
     images = []
-    for cl in movie.castlibs.iter_by_nr():
+    for libnr,cl in movie.castlibs.iter_by_nr():
         print("==== Cast library \"%s\": ====" % (cl.name,))
         if cl.castmember_table==None: continue
 
         for i,cm in enumerate(cl.castmember_table):
             if cm==None: continue
             print("%d: Loading image \"%s\"" % (i, cm.name))
-            if not 'BITD' in cm.media: continue
-            castdata = cm.castdata
-            media = cm.media['BITD']
-            (w,h) = castdata.dims
-            (tw,th) = castdata.total_dims
-            bpp = castdata.bpp
-            clut = None
-            if castdata.palette > 0: # TODO: -101 is Windows system palette
-                clut = cl.get_cast_member(castdata.palette)
-                if clut and 'CLUT' not in clut.media:
-                    print("No CLUT media in a palette!")
-                clut = clut and clut.media.get('CLUT')
-                clut = clut and clut.data[::2]
-            image = shockabsorber.loader.rle.bytes_to_image((w,h, tw, bpp, media.decoded), clut=clut)
+            image = atlas.get_region((libnr, i+1))
+            if image==None: continue
             images.append(image)
             #if len(images)>50: break
-    print("Image count: %d" % len(images))
-
-    W = 8000; H = 1200
-    window = pyglet.window.Window(width=W, height=H)
+    print("Image count: %d in %s" % (len(images), atlas))
+
+    # Laid out once, and drawn as one batch:
+    batch = pyglet.graphics.Batch()
+    sprites = []
+    y = 0; x=0; maxw = 0
+    for img in images:
+        w = img.width
+        h = img.height
+        if y+h>=H:
+            y = 0; x+= maxw + 20; maxw = 0
+            if x>=W: break
+        sprites.append(pyglet.sprite.Sprite(img, x, y, batch=batch))
+        if w>maxw: maxw = w
+        y += h + 20
 
     @window.event
     def on_draw():
         window.clear()
-
-        y = 0; x=0; maxw = 0
-        for img in images:
-            w = img.width
-            h = img.height
-            if y+h>=H:
-                y = 0; x+= maxw + 20; maxw = 0
-                if x>=W: break
-            img.blit(x,y)
-            if w>maxw: maxw = w
-            y += h + 20
+        batch.draw()
 
     pyglet.app.run()
 
 
-def show_frames(movie):
+def show_frames(movie, image_cache=None):
     if movie.frames==None:
         print("==== (No score.) ====")
         return
 
-    def rle_decode_member(member):
-        if not 'BITD' in member.media: return None
-        castdata = member.castdata
-        media = member.media['BITD']
-        (w,h) = castdata.dims
-        (tw,th) = castdata.total_dims
-        bpp = castdata.bpp
-        return (w,h, tw, bpp, media.decoded)
-
-    loaded_images = {}
-    def get_image(member_ref, ink, clut):
-        cache_key = (member_ref,ink)
-        if not (cache_key in loaded_images):
-            (libnr, membernr) = member_ref
-            member = movie.castlibs.get_cast_member(libnr, membernr)
-            if ink != 9: # not Mask
-                image = shockabsorber.loader.rle.bytes_to_image(rle_decode_member(member), clut=clut)
-            else:
-                mask_member = movie.castlibs.get_cast_member(libnr, membernr+1)
-                image_data = rle_decode_member(member)
-                mask_data = rle_decode_member(mask_member)
-                print("DB| Masked-ink sprite: %s / %s" % (member.name, mask_member.name))
-                image = shockabsorber.loader.rle.bytes_and_mask_to_image(image_data, mask_data)
-            loaded_images[cache_key] = image
-        return loaded_images[cache_key]
-
-
-    cursor = movie.frames.create_cursor()
-    def draw_frame(fnr):
-        print("==== Frame #%d ====" % fnr)
-        cursor.go_to_frame(fnr)
-        for snr in range(movie.frames.sprite_count):
-            sprite = cursor.get_sprite(snr)
-            if sprite.interval_ref > 0:
-                (libnr, membernr) = sprite.member_ref
-                member = movie.castlibs.get_cast_member(libnr, membernr)
-                (posX,posY) = sprite.get_pos()
-                (szX,szY) = sprite.get_size()
-                if member is None: continue
-                castdata = member.castdata
-                (ancX, ancY) = castdata.get_anchor()
-                bltX = posX-ancX; bltY = 768-(posY-ancY)
-                if member.type==1:
-                    clut = None
-                    if castdata.palette > 0:
-                        clut = movie.castlibs.get_cast_member(libnr, castdata.palette)
-                        clut = clut and clut.media.get('CLUT')
-                        clut = clut and clut.data[::2]
-                    image = get_image(sprite.member_ref, sprite.ink, clut)
-                    if image==None:
-                        #print "DB| image==None for member_ref %s" % (sprite.member_ref,)
-                        continue
-                elif member.type==15 and 'XMED' in member.media and member.media['XMED'].data[4:8]==b'\0\0\0\1':
-                    try:
-                        from oglgnash import widget
-                    except ImportError:
-                        continue
-                    image = widget(member.media['XMED'].data[12:])
-                else:
-                    continue
-                #print "DB| blit: name=%s pos=%s anchor=%s size=%s blitpos=%s" % (
-                #    member.get_name(), (posX,posY), (ancX,ancY), (szX,szY), (bltX,bltY))
-                image.blit(bltX, bltY-szY)
+    if image_cache==None: image_cache = ImageCache(movie.castlibs)
 
     W = 1024; H = 768
-    window = pyglet.window.Window(width=W, height=H)
+    window = pyglet.window.Window(width=W, height=H) # Before any texture is made.
     glEnable(GL_BLEND)
     glBlendFunc(GL_SRC_ALPHA, GL_ONE_MINUS_SRC_ALPHA)
 
+    # The compositor only places the sprites; the atlas holds their images.
+    layout = Compositor(movie.castlibs, (W, H), image_cache=image_cache)
+    frame_batch = FrameBatch(movie.frames, layout, SpriteAtlas(image_cache))
+    flash_cursor = movie.frames.create_cursor()
+    def draw_flash_sprites(fnr):
+        try:
+            from oglgnash import widget
+        except ImportError:
+            return
+        flash_cursor.go_to_frame(fnr)
+        sprites = flash_cursor.get_sprite_records()
+        for snr in sprites.occupied_channels():
+            if sprites.interval_ref[snr] <= 0: continue
+            member = movie.castlibs.get_cast_member(int(sprites.castlib[snr]), int(sprites.member[snr]))
+            if member is None: continue
+            if member.type==15 and 'XMED' in member.media and member.media['XMED'].data[4:8]==b'\0\0\0\1':
+                (ancX, ancY) = member.castdata.get_anchor()
+                (posX,posY) = (int(sprites.pos_x[snr]), int(sprites.pos_y[snr]))
+                szY = int(sprites.height[snr])
+                widget(member.media['XMED'].data[12:]).blit(posX-ancX, H-(posY-ancY)-szY)
+
     fnr_label = pyglet.text.Label(font_size=30, x=25, y=25, color=(255,255,0,0))
 
     ani_state = {"fnr": 1}
     @window.event
     def on_draw():
         window.clear()
-        draw_frame(ani_state["fnr"])
+        frame_batch.draw()
+        draw_flash_sprites(ani_state["fnr"])
         fnr_label.draw()
 
     @window.event
@@ -180,6 +156,8 @@ def show_frames(movie):
     def update(dt):
         ani_state["fnr"] += 1
         fnr = ani_state["fnr"]
+        print("==== Frame #%d: %s ====" % (fnr, frame_batch))
+        frame_batch.go_to_frame(fnr)
         fnr_label.text = "Frame %d" % fnr
         on_draw()
 
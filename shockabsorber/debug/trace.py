@@ -0,0 +1,96 @@
+#### Purpose:
+# Leveled tracing of what the parsers see, per subsystem.
+#
+# Trace points look like
+#     if tr.debug_on: tr.debug("KEY* entry #%d: %s", i, entry)
+# A disabled trace point costs one attribute test; its arguments are
+# neither computed nor formatted. (For cheap arguments, the guard may
+# be left out: formatting is still deferred until the level is checked.)
+#
+# Levels are set per subsystem ("envelope", "loader", "cast", "score",
+# "script", "resolver", "image", "render"), or for all of them, either by
+# calling set_level()/configure() or through the environment, e.g.
+#     SHOCKABSORBER_TRACE=all=info,score=debug
+# Messages go to the sink, by default stderr; see set_sink().
+
+import os
+import sys
+
+OFF, WARN, INFO, DEBUG, DUMP = range(5)
+LEVELS_BY_NAME = {'off': OFF, 'warn': WARN, 'info': INFO, 'debug': DEBUG, 'dump': DUMP}
+LEVEL_NAMES = dict((v,k) for k,v in LEVELS_BY_NAME.items())
+
+class Tracer: #------------------------------
+    def __init__(self, subsystem, level):
+        self.subsystem = subsystem
+        self.set_level(level)
+
+    def __repr__(self):
+        return "<Tracer %s level=%s>" % (self.subsystem, LEVEL_NAMES[self.level])
+
+    def set_level(self, level):
+        self.level = level
+        self.warn_on = level >= WARN
+        self.info_on = level >= INFO
+        self.debug_on = level >= DEBUG
+        self.dump_on = level >= DUMP
+
+    def warn(self, fmt, *args):
+        if self.warn_on: emit(self.subsystem, WARN, fmt, args)
+
+    def info(self, fmt, *args):
+        if self.info_on: emit(self.subsystem, INFO, fmt, args)
+
+    def debug(self, fmt, *args):
+        if self.debug_on: emit(self.subsystem, DEBUG, fmt, args)
+
+    def dump(self, fmt, *args):
+        if self.dump_on: emit(self.subsystem, DUMP, fmt, args)
+#--------------------------------------------------
+
+def stderr_sink(subsystem, level, message):
+    sys.stderr.write("DB| [%s] %s\n" % (subsystem, message))
+
+default_level = WARN
+tracers = {}
+sink = stderr_sink
+
+def emit(subsystem, level, fmt, args):
+    sink(subsystem, level, fmt % args if args else fmt)
+
+def get_tracer(subsystem):
+    tracer = tracers.get(subsystem)
+    if tracer == None:
+        tracer = tracers[subsystem] = Tracer(subsystem, default_level)
+    return tracer
+
+def set_sink(new_sink):
+    """new_sink(subsystem, level, message) receives every message emitted.
+    None discards them."""
+    global sink
+    sink = new_sink if new_sink != None else (lambda subsystem, level, message: None)
+
+def set_level(subsystem, level):
+    """Sets the level of one subsystem, or of all of them ('all')."""
+    global default_level
+    if isinstance(level, str): level = LEVELS_BY_NAME[level.lower()]
+    if subsystem == 'all':
+        default_level = level
+        for tracer in tracers.values():
+            tracer.set_level(level)
+    else:
+        get_tracer(subsystem).set_level(level)
+
+def configure(spec):
+    """Applies a specification like 'all=info,score=debug'."""
+    for item in spec.split(','):
+        item = item.strip()
+        if not item: continue
+        if '=' in item:
+            (subsystem, level) = item.split('=', 1)
+        else:
+            (subsystem, level) = ('all', item)
+        set_level(subsystem.strip(), level.strip())
+
+if os.environ.get("SHOCKABSORBER_TRACE"):
+    configure(os.environ["SHOCKABSORBER_TRACE"])
@@ -1,13 +1,18 @@
 #!/usr/bin/python
 
 import struct
+import threading
 import zlib
+from multiprocessing.pool import ThreadPool
 from shockabsorber.model.sections import Section, SectionMap
-from shockabsorber.loader.util import SeqBuffer, rev
+from shockabsorber.loader.util import SeqBuffer, rev, pread
+from shockabsorber.debug import trace
+
+tr = trace.get_tracer("envelope")
 
 class SectionMapImpl(SectionMap):  #------------------------------
-    def __init__(self, entries):
-        SectionMap.__init__(self, entries)
+    def __init__(self, entries, cache=None):
+        SectionMap.__init__(self, entries, cache, [e.nr for e in entries])
         entries_by_nr = {}
         for e in self.entries:
             entries_by_nr[e.nr] = e
@@ -31,20 +36,58 @@ class CommonSectionImpl(Section):  #------------------------------
 #--------------------------------------------------
 
 class ZSectionImpl(CommonSectionImpl):  #------------------------------
+    """A zlib-compressed section.
+
+    With eager decompression (see start_eager_decompression), a pool
+    of worker threads reads and decompresses the sections in the
+    background. Whoever gets to a section first (a worker, or a caller
+    of bytes()) claims it: the others skip it, or (callers) wait for
+    that section only.
+    """
     def __init__(self,nr,tag,size,offset, file):
         CommonSectionImpl.__init__(self,nr,tag,size)
         self.offset = offset
         self.file = file
+        self.claim_lock = threading.Lock()
+        self.claimed = False
+        self.worker_done = None # Set while, and after, a worker decompresses it.
+
+    def decompress_eagerly(self):
+        """Worker task: decompresses the section, unless already claimed."""
+        with self.claim_lock:
+            if self.claimed: return
+            self.claimed = True
+            done = self.worker_done = threading.Event()
+        try:
+            self.store_bytes(self.decompress())
+        except Exception as e:
+            # Whoever asks for the section tries again, and gets the error.
+            tr.warn("Eager decompression of section #%d failed: %s", self.nr, e)
+        finally:
+            done.set()
 
     def read_bytes(self):
-        file = self.file
-        print("DB| read_bytes (ZSectionImpl #%d): 0x%x+0x%x" % (self.nr, self.offset, self.size))
-        file.seek(self.offset)
-        # xheader = file.read(8)
+        with self.claim_lock:
+            done = self.worker_done
+            self.claimed = True # No worker needs to start on it now.
+        if done != None:
+            done.wait()
+            # Unless evicted from the cache meanwhile (or failed):
+            the_bytes = self.stored_bytes()
+            if the_bytes != None: return the_bytes
+        return self.decompress()
+
+    def stored_bytes(self):
+        if self.cache == None: return self.the_bytes
+        return self.cache.get(self, count=False)
+
+    def decompress(self):
+        if tr.debug_on: tr.debug("read_bytes (ZSectionImpl #%d): 0x%x+0x%x", self.nr, self.offset, self.size)
+        # xheader = pread(self.file, self.offset, 8)
         # [tag,size] = struct.unpack('!4si', xheader)
         # if tag != self.tag:
         #     raise Exception("section header is actually %s, not %s as expected" % (tag, self.tag))
-        comp_data = file.read(self.size)
+        comp_data = pread(self.file, self.offset, self.size)
         return zlib.decompress(comp_data)
 #--------------------------------------------------
 
@@ -67,10 +110,8 @@ class UncompSectionImpl(CommonSectionImpl):  #------------------------------
         self.file = file
 
     def read_bytes(self):
-        print("DB| DCR read_bytes: @%d+%d" % (self.offset, self.size))
-        file = self.file
-        file.seek(self.offset)
-        return file.read(self.size)
+        if tr.debug_on: tr.debug("DCR read_bytes: @%d+%d", self.offset, self.size)
+        return pread(self.file, self.offset, self.size)
 #--------------------------------------------------
 
 class ABMPEntry:  #------------------------------
@@ -90,7 +131,7 @@ def parse_abmp_section(blob, file):
     v1 = buf.unpackVarint()
     v2 = buf.unpackVarint()
     section_count = buf.unpackVarint()
-    print("ABMP header: %s" % [v1,v2, section_count])
+    if tr.info_on: tr.info("ABMP header: %s", [v1,v2, section_count])
 
     #w1sum=0; w2sum=0; w3sum=0; w4sum=0
     csum=0; usum=0
@@ -103,12 +144,12 @@ def parse_abmp_section(blob, file):
         repr_mode = buf.unpackVarint()
         [tag] = buf.unpack('<4s')
         tag = rev(tag)
-        print("ABMP entry: %s" % ([id, tag,
-                                   offset, comp_size, decomp_size,
-                                   repr_mode]))
+        if tr.debug_on: tr.debug("ABMP entry: %s", [id, tag,
+                                                    offset, comp_size, decomp_size,
+                                                    repr_mode])
         sections.append(ABMPEntry(id, tag, comp_size, offset, repr_mode))
 
-    print("Bytes left in ABMP section: %d" % buf.bytes_left())
+    tr.info("Bytes left in ABMP section: %d", buf.bytes_left())
     # print "Sums: %s" % [csum, usum]
     return sections
 #--------------------------------------------------
@@ -120,25 +161,25 @@ def create_section_map(f, loader_context):
         [stag] = struct.unpack('<4s', xsectheader)
         stag = rev(stag)
         ssize = read_varint(f)
-        print("stag=%s ssize=%d" % (stag, ssize))
+        tr.info("stag=%s ssize=%d", stag, ssize)
         if ssize==0:
             break
         else:
             sect_data = f.read(ssize)
         if stag == "Fcdr" or stag == "FGEI":
             sect_data = zlib.decompress(sect_data)
-            print("ssize decompressed=%d" % (len(sect_data)))
+            tr.info("ssize decompressed=%d", len(sect_data))
         elif stag == "ABMP":
             buf = SeqBuffer(sect_data)
             sect_data_null = buf.unpackVarint()
             sect_data_size = buf.unpackVarint()
             sect_data = zlib.decompress(buf.peek_bytes_left())
             del buf
-            print("ssize decompressed=%d=%d" % (sect_data_size, len(sect_data)))
+            tr.info("ssize decompressed=%d=%d", sect_data_size, len(sect_data))
             abmp = parse_abmp_section(sect_data, f)
-            print("DB| ABMP: %s" % abmp)
+            tr.dump("ABMP: %s", abmp)
         if stag != "ABMP":
-            print ("DB| %s -> %s" % (stag, sect_data))
+            tr.dump("%s -> %r", stag, sect_data)
     section_base_pos = f.tell()
 
     # entries_by_nr = {}
@@ -148,10 +189,10 @@ def create_section_map(f, loader_context):
     # Fetch the sections:
     sections = []
     sections_in_ils_by_nr = {}
-    ils_section_bytes = None
+    ils_section = None
     for e in abmp:
         snr = e.nr
-        print("DB| section nr %s: %s" % (snr,e))
+        if tr.debug_on: tr.debug("section nr %s: %s", snr, e)
         if e.offset == -1:
             # Compressed, in ILS section.
             section = LateSectionImpl(snr,e.tag,e.size)
@@ -173,17 +214,24 @@ def create_section_map(f, loader_context):
             # entries_by_nr[snr] = (e.tag,sdata)
         sections.append(section)
         if e.tag=="ILS ":
-            ils_section_bytes = section.bytes()
+            ils_section = section
+
+    section_map = SectionMapImpl(sections, loader_context.section_cache)
+
+    if loader_context.decompress_threads > 0:
+        start_eager_decompression(sections, ils_section,
+                                  loader_context.decompress_threads)
 
     if sections_in_ils_by_nr:
-        read_ILS_section_into(ils_section_bytes,
+        read_ILS_section_into(ils_section.bytes(),
                               sections_in_ils_by_nr,
                               sections)
 
     # print "Sections=%s" % (sections.keys())
-    print("Sections:")
-    for e in sections:
-        print("  %d: %s" % (e.nr, e))
+    if tr.debug_on:
+        tr.debug("Sections:")
+        for e in sections:
+            tr.debug("  %d: %s", e.nr, e)
 
     # Debug:
     # for snr in sections:
@@ -193,7 +241,22 @@ def create_section_map(f, loader_context):
     #     if tag=="Lnam":
     #         print "DB| %d: %s->%s" % (snr, tag, LnamSection.parse(data))
 
-    return SectionMapImpl(sections)
+    return section_map
+
+def start_eager_decompression(sections, ils_section, thread_count):
+    """Hands all compressed sections to a pool of thread_count threads,
+    which read and decompress them. zlib releases the GIL, so this runs
+    in parallel. The ILS section goes first, since it is needed right
+    away; sections needed before the workers get to them are
+    decompressed by the caller instead."""
+    pool = ThreadPool(thread_count)
+    compressed = [s for s in sections if isinstance(s, ZSectionImpl)]
+    if ils_section in compressed:
+        compressed.remove(ils_section)
+        compressed.insert(0, ils_section)
+    for section in compressed:
+        pool.apply_async(section.decompress_eagerly)
+    pool.close() # The workers exit once the queue is drained.
 
 def read_ILS_section_into(ils_data, entries_by_nr, dest):
     buf = SeqBuffer(ils_data)
@@ -3,24 +3,33 @@
 # Parse and create section map for DXR files.
 #
 
+import mmap
 import struct
-from shockabsorber.model.sections import Section, SectionMap
-from shockabsorber.loader.util import SeqBuffer
+from shockabsorber.model.sections import Section, SectionMap, normalize_tag
+from shockabsorber.loader.util import SeqBuffer, pread
+from shockabsorber.debug import trace
+
+tr = trace.get_tracer("envelope")
 
 def create_section_map(f, loader_context):
-    return find_and_read_section(f, b"mmap", loader_context)
+    if loader_context.use_mmap:
+        mapping = map_file(f)
+    else:
+        mapping = None
+    return find_and_read_section(f, b"mmap", loader_context, mapping)
 
-def find_and_read_section(f, tag_to_find, loader_context):
+def find_and_read_section(f, tag_to_find, loader_context, mapping=None):
     while True:
         xheader = f.read(8)
         buf = SeqBuffer(xheader, loader_context.is_little_endian)
         tag = buf.readTag()
         [size] = buf.unpack('>i', '<i')
 
-        print("  tag=%s" % bytes(tag))
-        if bytes(tag)==tag_to_find:
+        tag = normalize_tag(tag)
+        if tr.debug_on: tr.debug("  tag=%s", tag)
+        if tag==tag_to_find:
             blob = f.read(size)
-            return parse_mmap_section(blob, f, loader_context)
+            return parse_mmap_section(blob, f, loader_context, mapping)
         elif tag==b"imap":
             blob = f.read(size)
             buf = SeqBuffer(blob, loader_context.is_little_endian)
@@ -29,22 +38,24 @@ def find_and_read_section(f, tag_to_find, loader_context):
         else:
             f.seek(size, 1)
 
-def parse_mmap_section(blob, file, loader_context):
+def parse_mmap_section(blob, file, loader_context, mapping=None):
     buf = SeqBuffer(blob, loader_context.is_little_endian)
     [v1,v2,nElems,nUsed,junkPtr,v3,freePtr] = buf.unpack('>HHiiiii', '<HHiiiii')
-    print("mmap header: %s" % [v1,v2,nElems,nUsed,junkPtr,v3,freePtr])
+    if tr.info_on: tr.info("mmap header: %s", [v1,v2,nElems,nUsed,junkPtr,v3,freePtr])
 
     sections = []
     for i in range(nUsed):
-        tag = buf.readTag()
+        tag = normalize_tag(buf.readTag())
         [size, offset, w1,w2, link] = buf.unpack('>IIhhi', '<IIhhi')
-        #print("mmap entry: %s" % [tag, size, offset, w1,w2, link])
+        if tr.debug_on: tr.debug("mmap entry: %s", [tag, size, offset, w1,w2, link])
         if tag==b"free" or tag==b"junk":
             section = NullSection(tag)
+        elif mapping != None:
+            section = MappedSectionImpl(tag, size, offset, mapping, loader_context)
         else:
             section = SectionImpl(tag, size, offset, file, loader_context)
         sections.append(section)
-    return SectionMap(sections)
+    return SectionMap(sections, loader_context.section_cache)
 
 
 class SectionImpl(Section):  #------------------------------
@@ -55,17 +66,77 @@ class SectionImpl(Section):  #------------------------------
         self.loader_context = loader_context
 
     def read_bytes(self):
-        file = self.file
-        file.seek(self.offset)
-        xheader = file.read(8)
+        xheader = pread(self.file, self.offset, 8)
         buf = SeqBuffer(xheader, self.loader_context.is_little_endian)
         tag = buf.readTag()
         #[dummy_size] = buf.unpack('>i', '<i')
         if tag != self.tag:
             raise Exception("section header is actually %s, not %s as expected" % (tag, self.tag))
-        return file.read(self.size)
+        return pread(self.file, self.offset+8, self.size)
 #--------------------------------------------------
 
+class MappedSectionImpl(Section):  #------------------------------
+    """A section which is a zero-copy slice of a memory-mapped file."""
+    def __init__(self,tag,size,offset, mapping, loader_context):
+        Section.__init__(self,tag,size)
+        self.offset = offset
+        self.mapping = mapping
+        self.loader_context = loader_context
+
+    def read_bytes(self):
+        buf = SeqBuffer(self.mapping.view(self.offset, 8),
+                        self.loader_context.is_little_endian)
+        tag = buf.readTag()
+        if tag != self.tag:
+            raise Exception("section header is actually %s, not %s as expected" % (tag, self.tag))
+        return self.mapping.view(self.offset+8, self.size)
+#--------------------------------------------------
+
+class MappedFile:  #------------------------------
+    """A read-only mapping of a whole file, handing out memoryviews of
+    ranges of it without copying.
+
+    On Python 3 these are slices of a memoryview of the mapping. On
+    Python 2, an mmap does not support memoryview, but a buffer object
+    of a range of it does.
+    """
+    def __init__(self, file):
+        self.mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            self.whole_view = memoryview(self.mmap)
+        except TypeError:
+            self.whole_view = None
+
+    def __len__(self):
+        return len(self.mmap)
+
+    def can_view(self):
+        return self.whole_view != None or has_buffer_type
+
+    def view(self, offset, size):
+        if self.whole_view != None:
+            return self.whole_view[offset : offset+size]
+        return memoryview(buffer(self.mmap, offset, size))
+
+    def close(self):
+        self.mmap.close()
+#--------------------------------------------------
+
+try:
+    buffer
+    has_buffer_type = True
+except NameError:
+    has_buffer_type = False
+
+def map_file(f):
+    """Returns a MappedFile of f, or None if ranges of the mapping could
+    only be had as copies; sections are then read from the file as usual."""
+    mapping = MappedFile(f)
+    if mapping.can_view(): return mapping
+    tr.warn("use_mmap: memory-mapped sections are not supported on this platform; reading sections from the file")
+    mapping.close()
+    return None
+
 class NullSection(Section):  #------------------------------
     def __init__(self,tag):
         Section.__init__(self,tag,-1)
@@ -0,0 +1,104 @@
+#### Purpose:
+# Decoded images of bitmap cast members, shared between whatever draws
+# them (viewers, renderers, exporters), within a byte budget.
+#
+
+from shockabsorber.model.cache import LRUCache
+from shockabsorber.debug import trace
+from . import rle
+
+tr = trace.get_tracer("image")
+
+COPY_INK = 0
+MATTE_INK = 8 # The white surrounding the picture is transparent.
+MASK_INK = 9 # The member after the sprite's member is its mask.
+
+def image_size(image):
+    """Estimated size in bytes of a decoded image (at 4 bytes per pixel)."""
+    return 4 * image.width * image.height
+
+class ImageCache: #------------------------------
+    """Maps (castlib nr, member nr, ink, palette) to the decoded image of
+    a bitmap member of the given cast libraries, keeping the most recently
+    used images within max_bytes.
+
+    Only the mask ink and the inks in ink_filters give images of their
+    own; for the others, the ink is left to the drawing code and the
+    image is shared.
+    The palette is a member number in the same cast library; by default
+    the one the bitmap names.
+
+    make_image(image_data, clut) and make_masked_image(image_data,
+    mask_data, clut) build the images from (width, height, fullwidth,
+    bpp, pixels) tuples; by default, pyglet images through rle.
+    ink_filters maps inks to functions from image to image for that ink.
+    """
+    def __init__(self, castlibs, max_bytes=64*1024*1024,
+                 make_image=rle.bytes_to_image, make_masked_image=rle.bytes_and_mask_to_image,
+                 size_of=image_size, ink_filters=None):
+        self.castlibs = castlibs
+        self.make_image = make_image
+        self.make_masked_image = make_masked_image
+        self.ink_filters = ink_filters or {}
+        self.decoding_inks = (MASK_INK,) + tuple(self.ink_filters)
+        self.images = LRUCache(max_bytes, size_of)
+
+    def __repr__(self):
+        return "<ImageCache %r>" % (self.images,)
+
+    def get_image(self, member_ref, ink=COPY_INK, palette=None):
+        """Returns the image of the member, or None if it is not a bitmap."""
+        (libnr, membernr) = member_ref
+        member = self.castlibs.get_cast_member(libnr, membernr)
+        image_data = member_image_data(member)
+        if image_data == None: return None
+        if palette == None: palette = member.castdata.palette
+        if ink not in self.decoding_inks: ink = COPY_INK
+        key = (libnr, membernr, ink, palette)
+
+        image = self.images.get(key)
+        if image is None:
+            if ink == MASK_INK:
+                mask_member = self.castlibs.get_cast_member(libnr, membernr+1)
+                mask_data = member_image_data(mask_member)
+                if mask_data == None:
+                    tr.warn("Mask-ink sprite of %s: no mask member", member_ref)
+                    image = self.make_image(image_data, self.get_clut(libnr, palette))
+                else:
+                    image = self.make_masked_image(image_data, mask_data, self.get_clut(libnr, palette))
+            else:
+                image = self.make_image(image_data, self.get_clut(libnr, palette))
+                if ink in self.ink_filters: image = self.ink_filters[ink](image)
+            self.images.put(key, image)
+        return image
+
+    def get_clut(self, libnr, palette):
+        """Returns the RGB palette of the given palette member, or None
+        for the default palette."""
+        if palette <= 0: return None # TODO: -101 is Windows system palette
+        clut = self.castlibs.get_cast_member(libnr, palette)
+        if clut == None: return None
+        clut = clut.media.get(b'CLUT')
+        if clut == None:
+            tr.warn("No CLUT media in palette #%d", palette)
+            return None
+        return clut.data[::2]
+
+    def hit_rate(self):
+        return self.images.hit_rate()
+
+    def stats(self):
+        return self.images.stats()
+
+    def clear(self):
+        self.images.clear()
+#--------------------------------------------------
+
+def member_image_data(member):
+    """Returns the (width, height, fullwidth, bpp, pixels) of a bitmap
+    member, or None."""
+    if member == None or not b'BITD' in member.media: return None
+    castdata = member.castdata
+    (w,h) = castdata.dims
+    (tw,th) = castdata.total_dims
+    return (w, h, tw, castdata.bpp, member.media[b'BITD'].decoded)
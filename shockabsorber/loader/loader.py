@@ -5,41 +5,83 @@
 
 import os
 import struct
+import threading
 import time
-from shockabsorber.model.sections import Section, SectionMap, AssociationTable
-from shockabsorber.model.cast import CastLibrary, CastLibraryTable
+import weakref
+from shockabsorber.model.sections import Section, SectionMap, AssociationTable, normalize_tag
+from shockabsorber.model.cast import CastLibrary, CastLibraryTable, LazyCastMemberTable
 from shockabsorber.model.movie import Movie
+from shockabsorber.model.frames import FrameLabelIndex
+from shockabsorber.model.cache import LRUCache
 from shockabsorber.loader.util import SeqBuffer, rev, half_expect
+from shockabsorber.debug import trace
+from . import packbits
 from . import script_parser
 from . import score_parser
 import shockabsorber.loader.dxr_envelope
 import shockabsorber.loader.dcr_envelope
 
+tr = trace.get_tracer("loader")
+cast_tr = trace.get_tracer("cast")
+
 class LoaderContext: #------------------------------
-    """Contains information about endianness and file format version of a file."""
-    def __init__(self, file_tag, is_little_endian):
+    """Contains information about endianness and file format version of a file,
+    plus the loading options requested by the caller.
+
+    Options:
+    - use_mmap: map the whole file into memory and hand out sections
+      as zero-copy views of the mapping (RIFX/XFIR files only).
+    - decompress_threads: if positive, decompress all zlib-compressed
+      sections of an Afterburner (FGDM) file eagerly, on a pool of this
+      many threads. If zero, sections are decompressed on first access.
+      The file is kept open for the threads.
+    - section_cache: an LRUSectionCache to keep section bytes in, instead
+      of keeping them for the lifetime of the movie. Evicted sections are
+      read again from the file, which is therefore kept open.
+    - lazy_cast_members: parse each cast member (and its media) when it
+      is first asked for, rather than all of them at load time.
+      The file is kept open for this.
+    - packed_score: keep the score's frame deltas in a compact
+      PackedFrameDeltaTable (a byte buffer plus arrays), decoded at load
+      time, instead of as FrameDelta objects decoded on first use.
+      This takes far less memory, but replaying frames is somewhat
+      slower (see bench_score.py).
+    """
+    def __init__(self, file_tag, is_little_endian, use_mmap=False, decompress_threads=0,
+                 section_cache=None, lazy_cast_members=False, packed_score=False):
         self.file_tag = file_tag
         self.is_little_endian = is_little_endian
+        self.use_mmap = use_mmap
+        self.decompress_threads = decompress_threads
+        self.section_cache = section_cache
+        self.lazy_cast_members = lazy_cast_members
+        self.packed_score = packed_score
+        self.dir_config = None # The DRCF settings, once read.
+
+    def needs_file_after_load(self):
+        # Eager decompression goes on in the background after loading.
+        return (self.section_cache != None or self.lazy_cast_members or
+                self.decompress_threads > 0)
 #--------------------------------------------------
 
 def parse_assoc_table(blob, loader_context):
     """ Takes a 'KEY*' section and returns an AssociationTable. """
     buf = SeqBuffer(blob, loader_context.is_little_endian)
     [v1,v2,nElems,nValid] = buf.unpack('>HHii', '<HHii')
-    print("KEY* header: %s" % [v1,v2,nElems,nValid])
+    if tr.info_on: tr.info("KEY* header: %s", [v1,v2,nElems,nValid])
     # v1 = table start offset, v2 = table entry size?
 
     atable = AssociationTable()
     for i in range(nValid):
         [owned_section_id, composite_id] = buf.unpack('>ii', '<ii')
-        tag = buf.readTag()
+        tag = normalize_tag(buf.readTag())
         castlib_assoc_id = composite_id >> 16
         owner_section_id = composite_id & 0xFFFF
-        print ("DB|   KEY* entry #%d: %s" % (i, [bytes(tag), owned_section_id, castlib_assoc_id, owner_section_id]))
+        if tr.debug_on: tr.debug("  KEY* entry #%d: %s", i, [tag, owned_section_id, castlib_assoc_id, owner_section_id])
         if owner_section_id == 1024:
-            atable.add_library_section(castlib_assoc_id, owned_section_id, bytes(tag))
+            atable.add_library_section(castlib_assoc_id, owned_section_id, tag)
         else:
-            atable.add_cast_media(owner_section_id, owned_section_id, bytes(tag))
+            atable.add_cast_media(owner_section_id, owned_section_id, tag)
     return atable
 
 def parse_cast_table_section(blob, loader_context):
@@ -92,7 +134,7 @@ class CastMember: #------------------------------
         attrs = []
         for i in range(len(offsets)-1):
             attr = blob_after_table[offsets[i]:offsets[i+1]]
-            print ("DB|   Cast member attr #%d: <%r>" % (i, attr))
+            if cast_tr.dump_on: cast_tr.dump("  Cast member attr #%d: <%r>", i, attr.tobytes())
             attrs.append(attr)
 
         if len(attrs)>=2 and len(attrs[1])>0:
@@ -111,8 +153,9 @@ class CastMember: #------------------------------
         else:
             mtime = None
 
-        print("DB| Cast-member common: name=\"%s\" ctime=%s mtime=%s  attrs=%s  misc=%s" % (
-            name, ctime and time.ctime(ctime), mtime and time.ctime(mtime), attrs, [v2,v3,v4,v5,v6, cast_id]))
+        if cast_tr.debug_on:
+            cast_tr.debug("Cast-member common: name=\"%s\" ctime=%s mtime=%s  attrs=%s  misc=%s",
+                          name, ctime and time.ctime(ctime), mtime and time.ctime(mtime), attrs, [v2,v3,v4,v5,v6, cast_id])
         noncommon = buf.peek_bytes_left()
 
         castdata = CastMember.parse_castdata(type, cast_id, SeqBuffer(noncommon), attrs)
@@ -158,7 +201,8 @@ class ImageCastType(CastType): #--------------------
         self.anchor = anchor
         self.bpp = bpp # Bits per pixel
         self.palette = palette
-        print("DB| ImageCastType: misc=%s\n  dims=%s total_dims=%s anchor=%s" % (misc, dims, total_dims, anchor))
+        if cast_tr.debug_on:
+            cast_tr.debug("ImageCastType: misc=%s\n  dims=%s total_dims=%s anchor=%s", misc, dims, total_dims, anchor)
         self.misc = misc
 
     def repr_extra(self):
@@ -178,7 +222,8 @@ class ImageCastType(CastType): #--------------------
         total_width = v10 & 0x7FFF
         v10 = "0x%x" % v10
         v12 = "0x%x" % v12
-        print("DB| ImageCastType.parse: ILE=%s %s" % (buf.is_little_endian, [(width, height), (total_width,height), bits_per_pixel]))
+        if cast_tr.debug_on:
+            cast_tr.debug("ImageCastType.parse: ILE=%s %s", buf.is_little_endian, [(width, height), (total_width,height), bits_per_pixel])
         misc = ((v10,v11), (v12,v13,v14), (v15,v17))
         return ImageCastType((width, height),
                              (total_width,height),
@@ -218,7 +263,7 @@ class ScriptCastType(CastType): #--------------------
     def __init__(self, id, misc):
         self.id = id
         self.misc = misc
-        print("DB| ScriptCastType: id=#%d misc=%s" % (id, misc))
+        if cast_tr.debug_on: cast_tr.debug("ScriptCastType: id=#%d misc=%s", id, misc)
 
     def repr_extra(self):
         return " id=#%d misc=%s" % (self.id, self.misc)
@@ -326,7 +371,8 @@ class XmedCastType(CastType): #--------------------
             [proplen] = buf.unpack('>I')
             propname = buf.readBytes(proplen)
             half_expect(buf.peek_bytes_left(), b'', 'XmedCastType.trailer')
-            print("DB| XmedCastType.parse: misc=%r npoints=%r misc2=%r, points=%r"%(misc, npoints, misc2, points))
+            if cast_tr.dump_on:
+                cast_tr.dump("XmedCastType.parse: misc=%r npoints=%r misc2=%r, points=%r", misc, npoints, misc2, points)
             info = (misc, misc2, points)
         return XmedCastType(med_type, info, *args)
 
@@ -360,17 +406,17 @@ class Media: #------------------------------
 class ediMMedia(Media): #------------------------------
     def __init__(self,snr,tag,blob):
         Media.__init__(self,snr,tag,blob)
-        if blob.startswith(b'\xff\xd8'):
+        if blob[:2] == b'\xff\xd8':
             self.media_type = b"JPEG"
             self.hdr = None
-        elif blob.startswith(b'\0\0\1@'):
+        elif blob[:4] == b'\0\0\1@':
             self.media_type = "MP3"
             buf = SeqBuffer(blob)
             [hdr_len] = buf.unpack('>I')
             self.hdr = buf.readBytes(hdr_len)
             self.music = buf.peek_bytes_left()
         else:
-            self.media_type = repr(blob[:16])
+            self.media_type = repr(bytes(blob[:16]))
             self.hdr = None
 
     def repr_extra(self):
@@ -381,22 +427,18 @@ class ThumMedia(Media): #------------------------------
         Media.__init__(self,snr,tag,blob)
         buf = SeqBuffer(blob)
         [self.height, self.width] = buf.unpack('>II')
-        to_read = self.height*self.width
-        res = bytearray()
-        while len(res) < to_read and not buf.at_eof():
-            [d] = buf.unpack('b')
-            if d < 0:
-                run_length = 1-d
-                v = buf.readBytes(1)
-                res.extend(v*run_length)
-            else:
-                lit_length = 1+d
-                res.extend(buf.readBytes(lit_length))
-        self.decoded = bytes(res)
 
     def repr_extra(self):
         return " %dx%d"%(self.width, self.height)
 
+    @property
+    def decoded(self):
+        return decode_cached(self)
+
+    def decode(self):
+        to_read = self.height*self.width
+        return packbits.unpack(self.data[8:], to_read, to_read)
+
 class XMEDMedia(Media): #------------------------------
     def __init__(self,snr,tag,blob):
         Media.__init__(self,snr,tag,blob)
@@ -404,40 +446,135 @@ class XMEDMedia(Media): #------------------------------
 class BITDMedia(Media): #------------------------------
     def __init__(self,snr,tag,blob):
         Media.__init__(self,snr,tag,blob)
-        buf = SeqBuffer(blob)
-        res = bytearray()
-        while not buf.at_eof():
-            [d] = buf.unpack('b')
-            if d < 0:
-                run_length = 1-d
-                v = buf.readBytes(1)
-                res.extend(v*run_length)
-            else:
-                lit_length = 1+d
-                res.extend(buf.readBytes(lit_length))
-        self.decoded = bytes(res)
+        self.size_hint = 0 # Expected decoded size, if known.
+
+    @property
+    def decoded(self):
+        return decode_cached(self)
+
+    def decode(self):
+        return packbits.unpack(self.data, size_hint=self.size_hint)
 #--------------------------------------------------
 
-def load_movie(filename):
-    with open(filename,'rb') as f:
-        (loader_context, sections_map, castlibs, castidx_order) = load_file(f)
+# Shared by all movies. Replace it to change the budget.
+decoded_pixel_cache = LRUCache(64*1024*1024)
+
+def decode_cached(media):
+    """Returns media.decode(), from decoded_pixel_cache if possible."""
+    decoded = decoded_pixel_cache.get(media)
+    if decoded is None:
+        decoded = media.decode()
+        decoded_pixel_cache.put(media, decoded)
+    return decoded
+
+def load_movie(filename, **options):
+    f = open(filename,'rb')
+    try:
+        (loader_context, sections_map, castlibs, castidx_order) = load_file(f, **options)
 
         script_ctx = script_parser.create_script_context(sections_map, loader_context)
         frame_labels = score_parser.parse_frame_label_section(sections_map, loader_context)
         score = score_parser.parse_score_section(sections_map, loader_context)
+    except:
+        f.close()
+        raise
+    # Otherwise, the sections keep the file open (and it is closed along with them):
+    if not loader_context.needs_file_after_load(): f.close()
+
+    labels = FrameLabelIndex(frame_labels) if frame_labels != None else None
+    (left, top, right, bottom) = loader_context.dir_config['stage_rect']
+    stage_size = (right-left, bottom-top) if right > left and bottom > top else None
+    return Movie(castlibs=castlibs, frames=score, scripts="TODO", labels=labels,
+                 stage_size=stage_size)
+
+def load_cast_library(filename, **options):
+    tr.info("load_cast_library: filename=%s", filename)
+    f = open(filename, 'rb')
+    try:
+        (loader_context, sections_map, castlibs, castidx_order) = load_file(f, **options)
+    except:
+        f.close()
+        raise
+    if not loader_context.needs_file_after_load(): f.close()
+
+    # TODO script_ctx = script_parser.create_script_context(sections_map, loader_context)
+    tr.info("load_cast_library: filename=%s done", filename)
+    return castlibs.get_cast_library(0)
+
+class CastLibraryCache: #------------------------------
+    """Keeps track of the external cast libraries loaded in this process,
+    so that one loaded cast is shared by every movie which links it.
+
+    Entries are keyed by real path, modification time and size, so a
+    changed file is loaded anew, and by the load options, which change
+    what is loaded. They are weak: a cast library stays cached as long
+    as some movie links it (see CastLibrary.link_to).
+
+    The lock is held only to look up and record entries; the loading
+    itself is done without it. A file being loaded is marked in
+    'loading', so that other threads asking for it wait for that load
+    rather than loading it too.
+    """
+    def __init__(self):
+        self.entries = weakref.WeakValueDictionary()
+        self.loading = {} # Key -> Event, set when the load is over.
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
 
-        return Movie(castlibs=castlibs, frames=score, scripts="TODO")
+    def __repr__(self):
+        return "<CastLibraryCache entries=%d hits=%d misses=%d>" % (
+            len(self.entries), self.hits, self.misses)
+
+    def load(self, filename, **options):
+        st = os.stat(filename)
+        key = (os.path.realpath(filename), st.st_mtime, st.st_size,
+               tuple(sorted(options.items())))
+        while True:
+            with self.lock:
+                castlib = self.entries.get(key)
+                if castlib != None:
+                    self.hits += 1
+                    tr.info("CastLibraryCache: reusing %s", filename)
+                    return castlib
+                loading = self.loading.get(key)
+                if loading == None:
+                    self.misses += 1
+                    loading = self.loading[key] = threading.Event()
+                    break
+            # Wait for the other load, then look again (it may have failed).
+            loading.wait()
+        try:
+            castlib = load_cast_library(filename, **options)
+            with self.lock:
+                self.entries[key] = castlib
+            return castlib
+        finally:
+            with self.lock:
+                del self.loading[key]
+            loading.set()
+#--------------------------------------------------
 
-def load_cast_library(filename):
-    print("DB| load_cast_library: filename=%s" % filename)
-    with open(filename, 'rb') as f:
-        (loader_context, sections_map, castlibs, castidx_order) = load_file(f)
+cast_library_cache = CastLibraryCache()
 
-        # TODO script_ctx = script_parser.create_script_context(sections_map, loader_context)
-        print("DB| load_cast_library: filename=%s" % filename)
-        return castlibs.get_cast_library(0)
+def load_shared_cast_library(filename, **options):
+    """Like load_cast_library, but through the process-wide cast_library_cache."""
+    return cast_library_cache.load(filename, **options)
 
-def load_file(f):
+def load_score(filename, **options):
+    """Loads just the score (a FrameSequence) of a movie file, without its
+    cast and scripts; None if it has none."""
+    f = open(filename, 'rb')
+    try:
+        (loader_context, sections_map) = load_section_map(f, **options)
+        score = score_parser.parse_score_section(sections_map, loader_context)
+    except:
+        f.close()
+        raise
+    if not loader_context.needs_file_after_load(): f.close()
+    return score
+
+def load_section_map(f, **options):
     xheader = f.read(12)
     [magic,size,tag] = struct.unpack('!4si4s', xheader)
 
@@ -449,31 +586,40 @@ def load_file(f):
     if magic != b"RIFX":
         raise Exception("Bad file type")
 
-    loader_context = LoaderContext(tag, is_little_endian)
-    print("DB| Loader context: %s / %s" % (tag, is_little_endian))
+    loader_context = LoaderContext(tag, is_little_endian, **options)
+    tr.info("Loader context: %s / %s", tag, is_little_endian)
     if (tag==b"MV93"):
         sections_map = shockabsorber.loader.dxr_envelope.create_section_map(f, loader_context)
     elif (tag==b"FGDM"):
         sections_map = shockabsorber.loader.dcr_envelope.create_section_map(f, loader_context)
     else:
         raise Exception("Bad file type")
+    return (loader_context, sections_map)
+
+def load_file(f, **options):
+    (loader_context, sections_map) = load_section_map(f, **options)
 
     (castlibs, assoc_table, dir_config) = read_singletons(sections_map, loader_context)
+    loader_context.dir_config = dir_config
     populate_cast_libraries(castlibs, assoc_table, sections_map, loader_context)
 
     # for e in sections_map.entries:
     #     tag = e.tag
     #     if tag=="STXT" or tag=="Sord" or tag=="XMED" or tag=="VWSC" or tag=="VWFI" or tag=="VWLB" or tag=="SCRF" or tag=="DRCF" or tag=="MCsL" or tag=="Cinf":
     #         print "section bytes for %s (len=%d): <%s>" % (tag, len(e.bytes()), e.bytes())
-    castorder_section_id = assoc_table.get_library_sections(0).get("Sord")
+    castorder_section_id = assoc_table.get_library_sections(0).get(b"Sord")
     if castorder_section_id == None:
         castidx_order = None
     else:
         castorder_e = sections_map[castorder_section_id]
         castidx_order = parse_cast_order_section(castorder_e.bytes(), loader_context)
-        for i,k in enumerate(castidx_order):
-            (clnr, cmnr) = k
-            print("DB| Cast order #%d: %s -> %s" % (i, k, castlibs.get_cast_member(clnr, cmnr)))
+        if tr.debug_on:
+            for i,k in enumerate(castidx_order):
+                (clnr, cmnr) = k
+                # Don't let debug output defeat lazy loading:
+                member = ("(not loaded)" if loader_context.lazy_cast_members else
+                          castlibs.get_cast_member(clnr, cmnr))
+                tr.debug("Cast order #%d: %s -> %s", i, k, member)
 
     return (loader_context, sections_map, castlibs, castidx_order)
 
@@ -495,42 +641,53 @@ def populate_cast_libraries(castlibs, assoc_table, sections_map, loader_context)
         # Read cast list:
         assoc_id = cl.assoc_id
         if assoc_id==0 and cl.name != None: continue
-        print("DB| populate_cast_libraries: sections: %s" % (assoc_table.get_library_sections(assoc_id),))
-        castlist_section_id = assoc_table.get_library_sections(cl.assoc_id).get("CAS*")
+        tr.info("populate_cast_libraries: sections: %s", assoc_table.get_library_sections(assoc_id))
+        castlist_section_id = assoc_table.get_library_sections(cl.assoc_id).get(b"CAS*")
         if castlist_section_id==None: continue
-        print("DB| populate_cast_libraries: CAS*-id=%d" % (castlist_section_id,))
+        tr.info("populate_cast_libraries: CAS*-id=%d", castlist_section_id)
         castlist_e = sections_map[castlist_section_id]
 
         cast_idx_table = parse_cast_table_section(castlist_e.bytes(), loader_context)
-        print("DB| populate_cast_libraries: idx_table=%s" % (cast_idx_table,))
-
-        def section_nr_to_cast_member(nr):
-            if nr==0: return None
-            cast_section = sections_map[nr].bytes()
-            castmember = CastMember.parse(cast_section,nr, loader_context)
-            populate_cast_member_media(castmember, cl.assoc_id, nr,
-                                       assoc_table, sections_map)
-            return castmember
-        cast_table = map(section_nr_to_cast_member, cast_idx_table)
-        print("DB| populate_cast_libraries: cast_table=%s" % (cast_table,))
+        tr.debug("populate_cast_libraries: idx_table=%s", cast_idx_table)
+
+        cast_table = LazyCastMemberTable(cast_idx_table,
+                                         cast_member_loader(cl.assoc_id, assoc_table,
+                                                            sections_map, loader_context))
+        if not loader_context.lazy_cast_members:
+            cast_table.prefetch(range(len(cast_table)))
+            if tr.debug_on: tr.debug("populate_cast_libraries: cast_table=%s", list(cast_table))
         cl.set_castmember_table(cast_table)
 
+def cast_member_loader(castlib_assoc_id, assoc_table, sections_map, loader_context):
+    def section_nr_to_cast_member(nr):
+        cast_section = sections_map[nr].bytes()
+        castmember = CastMember.parse(cast_section,nr, loader_context)
+        populate_cast_member_media(castmember, castlib_assoc_id, nr,
+                                   assoc_table, sections_map)
+        return castmember
+    return section_nr_to_cast_member
+
 def populate_cast_member_media(castmember, castlib_assoc_id, castmember_section_id, assoc_table, sections_map):
     medias = assoc_table.get_cast_media(castmember_section_id)
-    print("DB| populate_cast_member_media: %d,%d -> %s" % (castlib_assoc_id,castmember_section_id,medias))
+    if tr.debug_on: tr.debug("populate_cast_member_media: %d,%d -> %s", castlib_assoc_id,castmember_section_id,medias)
     for tag,media_section_id in medias.iteritems():
         media_section_e = sections_map[media_section_id]
         if media_section_e == None: continue
         # TODO: Load media more lazily.
         media_section = media_section_e.bytes()
         media = Media.parse(media_section_id, tag, media_section)
+        if isinstance(media, BITDMedia):
+            total_dims = getattr(castmember.castdata, 'total_dims', None)
+            if total_dims != None:
+                (total_width, height) = total_dims # total_width is in bytes.
+                media.size_hint = total_width*height
         castmember.add_media(tag, media)
 
 def parse_cast_lib_section(blob, loader_context):
     # Read header:
     buf = SeqBuffer(blob)
     [v1,nElems,ofsPerElem,nOffsets,v5] = buf.unpack('>iiHii')
-    print("DB| Cast lib section header: nElems=%d, nOffsets=%d, ofsPerElem=%d, misc=%s" % (nElems, nOffsets, ofsPerElem, [v1,v5]))
+    if tr.info_on: tr.info("Cast lib section header: nElems=%d, nOffsets=%d, ofsPerElem=%d, misc=%s", nElems, nOffsets, ofsPerElem, [v1,v5])
 
     # Read offset table:
     offsets = []
@@ -564,21 +721,21 @@ def parse_cast_lib_section(blob, loader_context):
             else:
                 item = subblob
             entry.append(item)
-        print("DB| Cast lib table entry #%d: %s" % (enr+1,entry))
+        if tr.debug_on: tr.debug("Cast lib table entry #%d: %s", enr+1, entry)
         [name, path, _zero, (low_idx,high_idx, assoc_id, self_idx)] = entry
         table.append(CastLibrary(enr+1, name, path, assoc_id, (low_idx,high_idx), self_idx))
 
     return CastLibraryTable(table)
 
 def parse_cast_order_section(blob, loader_context):
-    print("DB| parse_cast_order_section...")
+    tr.info("parse_cast_order_section...")
     buf = SeqBuffer(blob, loader_context)
     [_zero1, _zero2, nElems, nElems2, v5] = buf.unpack('>5i')
-    print("DB| parse_cast_order_section: header: %s" % ([_zero1, _zero2, nElems, nElems2, v5],))
+    if tr.info_on: tr.info("parse_cast_order_section: header: %s", [_zero1, _zero2, nElems, nElems2, v5])
     table = []
     for i in range(nElems):
         [castlib_nr, castmember_nr] = buf.unpack('>HH')
-        print("DB| parse_cast_order_section #%d: %s" % (i, (castlib_nr,castmember_nr)))
+        if tr.debug_on: tr.debug("parse_cast_order_section #%d: %s", i, (castlib_nr,castmember_nr))
         table.append((castlib_nr,castmember_nr))
     return table
 
@@ -588,9 +745,11 @@ def parse_dir_config(blob, loader_context):
     misc2 = buf.unpack('>3i')
     [palette] = buf.unpack('>i')
     misc3 = buf.peek_bytes_left()
+    [_len, _version, top, left, bottom, right] = misc1[:6]
     config = {
+        'stage_rect': (left, top, right, bottom),
         'palette': palette,
         'misc': [misc1, misc2, bytes(misc3)]
     }
-    print("DB| parse_dir_config: %r" % (config,))
+    tr.debug("parse_dir_config: %r", config)
     return config
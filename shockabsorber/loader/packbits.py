@@ -0,0 +1,49 @@
+#### Purpose:
+# Decoder for the PackBits-style run-length encoding used by BITD and
+# Thum media.
+#
+# Each control byte d is followed either by a literal run of d+1 bytes
+# (d >= 0), or by one byte to be repeated 1-d times (d < 0).
+# Truncated input is decoded as far as it goes.
+
+try:
+    # Optional compiled decoder with the same API (see packbits_accel.c):
+    from packbits_accel import unpack as _accel_unpack
+except ImportError:
+    _accel_unpack = None
+
+def unpack(data, limit=None, size_hint=0):
+    """Decodes data, returning the decoded bytes.
+
+    If limit is given, decoding stops before the first control byte
+    seen once at least limit bytes have been output (so the result may
+    be a little longer).
+    size_hint is the expected decoded size, e.g. from the image
+    dimensions; it only saves reallocations.
+    """
+    if _accel_unpack != None:
+        return _accel_unpack(data, -1 if limit==None else limit, size_hint)
+    return unpack_py(data, limit, size_hint)
+
+def unpack_py(data, limit=None, size_hint=0):
+    """The pure-Python implementation of unpack()."""
+    src = bytearray(data) # Indexing gives ints on both Python 2 and 3.
+    n = len(src)
+    out = bytearray(size_hint)
+    pos = 0
+    i = 0
+    while i < n:
+        if limit != None and pos >= limit: break
+        d = src[i]
+        i += 1
+        if d >= 128: # Run: 1-(d-256) copies of the next byte.
+            chunk = src[i:i+1] * (257-d)
+            i += 1
+        else: # Literal
+            chunk = src[i:i+d+1]
+            i += d+1
+        # Overwrites preallocated space, and extends the buffer at the end:
+        out[pos:pos+len(chunk)] = chunk
+        pos += len(chunk)
+    del out[pos:]
+    return bytes(out)
@@ -1,13 +1,36 @@
-import pyglet.image
+#### Purpose:
+# Conversion of decoded bitmap data to images.
+#
+# The *_pixels functions convert the planar or palette-indexed pixel
+# data to packed RGB/RGBA bytes (rows of width pixels, top row first);
+# with NumPy they work on whole arrays, otherwise row by row.
+# The make_*_image functions wrap their results in pyglet images.
 
-def bytes_to_image(image_data, clut=None):
-    if image_data==None: return None
+try:
+    import pyglet.image
+except ImportError:
+    pyglet = None # Only the *_pixels converters can be used.
+try:
+    import numpy
+except ImportError:
+    numpy = None
+from shockabsorber.debug import trace
+
+tr = trace.get_tracer("image")
+
+def padded_pixel_data(image_data):
     (width, height, fullwidth, bpp, pixdata) = image_data
     pixdata = bytearray(pixdata)
     if len(pixdata) < fullwidth*height:
-        print(len(pixdata), fullwidth*height, width*height*bpp//8)
-        print("Warning: too short pixel data (%d%%)" % (100*len(pixdata)//(fullwidth*height)))
+        tr.debug("pixel data: %d of %d bytes (%d at %d bpp)", len(pixdata), fullwidth*height, width*height*bpp//8, bpp)
+        tr.warn("too short pixel data (%d%%)", 100*len(pixdata)//(fullwidth*height))
         pixdata += b'\0'*(fullwidth*height-len(pixdata))
+    return pixdata
+
+def bytes_to_image(image_data, clut=None):
+    if image_data==None: return None
+    (width, height, fullwidth, bpp, pixdata) = image_data
+    pixdata = padded_pixel_data(image_data)
     if clut:
         return make_clut_image(width, height, fullwidth, pixdata, clut, bpp)
     elif bpp == 8:
@@ -17,10 +40,10 @@ def bytes_to_image(image_data, clut=None):
     elif bpp == 32:
         return make_32bit_rbg_image(width, height, fullwidth, pixdata)
     else:
-        print("Warning: RLE: Unknown bpp: %d" % bpp)
+        tr.warn("RLE: Unknown bpp: %d", bpp)
         return make_greyscale_image(width, height, fullwidth, pixdata)
 
-def bytes_and_mask_to_image(image_data, mask_data):
+def bytes_and_mask_to_image(image_data, mask_data, clut=None):
     if image_data==None: return None
     (width, height, fullwidth, bpp, pixdata) = image_data
     (width2, height2, fullwidth2, bpp2, pixdata2) = mask_data
@@ -32,8 +55,51 @@ def bytes_and_mask_to_image(image_data, mask_data):
     elif bpp == 32 and bpp2 == 8:
         return make_32bit_rbg_masked_image(width,height,fullwidth, width2,height2,fullwidth2, pixdata, pixdata2)
     else:
-        print("Warning: RLE: Unknown bpp: %d / %d" % (bpp,bpp2))
-        return make_greyscale_image(width, height, fullwidth, pixdata) # TODO
+        color_res = rgba_pixels_masked(image_data, mask_data, clut)
+        return pyglet.image.ImageData(width, height, 'RGBA', color_res, -4*width)
+
+def rgba_pixels(image_data, clut=None):
+    """Like bytes_to_image, but returns RGBA pixels instead of an image."""
+    (width, height, fullwidth, bpp, pixdata) = image_data
+    pixdata = padded_pixel_data(image_data)
+    if bpp == 32:
+        return rgba_pixels_32bit(width, height, fullwidth, pixdata)
+    elif bpp == 16:
+        rgb = rgb_pixels_16bit(width, height, fullwidth, pixdata)
+    elif bpp == 8:
+        rgb = rgb_pixels_8bit(width, height, fullwidth, pixdata, clut or system_clut)
+    elif bpp in (1, 2, 4):
+        indexes = expand_indexes(width, height, fullwidth, pixdata, bpp)
+        rgb = rgb_pixels_8bit(width, height, width, indexes, clut or grey_palette(bpp))
+    else:
+        tr.warn("RLE: Unknown bpp: %d", bpp)
+        rgb = rgb_pixels_8bit(width, height, fullwidth, pixdata, grey_palette(8))
+    return with_opaque_alpha(rgb, width, height)
+
+def rgba_pixels_masked(image_data, mask_data, clut=None):
+    """Like rgba_pixels, with the alpha taken from a mask bitmap, in
+    which index 0 (white) is transparent and the last index (black) opaque."""
+    (width, height, fullwidth, bpp, pixdata) = image_data
+    (width2, height2, fullwidth2, bpp2, pixdata2) = mask_data
+    rgba = rgba_pixels(image_data, clut)
+    alpha = padded_pixel_data(mask_data)
+    if bpp2 in (1, 2, 4):
+        alpha = expand_indexes(width2, height2, fullwidth2, alpha, bpp2).translate(index_alpha_table(bpp2))
+        fullwidth2 = width2
+    elif bpp2 != 8:
+        tr.warn("RLE: Unknown mask bpp: %d", bpp2)
+        return rgba
+    return with_alpha(rgba, 4, width, height, alpha, width2, height2, fullwidth2)
+
+def grey_palette(bpp):
+    """The palette from white (index 0) to black (the last index)."""
+    top = (1<<bpp) - 1
+    return bytes(bytearray(255 - (i*255)//top for i in range(top+1) for _ in range(3)))
+
+def index_alpha_table(bpp):
+    """Scales palette indices of the given depth to alpha values."""
+    top = (1<<bpp) - 1
+    return bytes(bytearray(min(255, (i*255)//top) for i in range(256)))
 
 def make_greyscale_image(width, height, fullwidth, data):
     return pyglet.image.ImageData(width, height, 'I', data, -fullwidth)
@@ -65,135 +131,187 @@ for b in r2:
             clut.extend([128*r, 128*g, 128*b])
 clut[-24:-21] = [192]*3
 clut = bytes(clut)
+system_clut = clut
 
 def make_8bit_rbg_image(width, height, fullwidth, data, clut=clut):
-    color_data = b""
-    for c in data: # outer white is transparent
-        nr = c*3
-        color_data += clut[nr:nr+3]
-    return pyglet.image.ImageData(width, height, 'RGB', color_data, -3*fullwidth)
-
-def bit_iterator(data):
-    for c in data:
-        for i in range(7,-1,-1):
-            yield (c>>i)&1
-
-def bpp_iterator(data, width, fullwidth, bpp):
-    while data:
-        no = b = 0
-        yc = 0
-        for bit in bit_iterator(data[:fullwidth]):
-            b=b<<1|bit
-            no += 1
-            if no != bpp: continue
-
-            yield b
-            b = 0
-            no = 0
-            yc += 1
-            if yc == width:
-                break
-        data = data[fullwidth:]
+    color_data = rgb_pixels_8bit(width, height, fullwidth, data, clut)
+    return pyglet.image.ImageData(width, height, 'RGB', color_data, -3*width)
 
 def make_clut_image(width, height, fullwidth, data, clut, bpp):
     if bpp == 8:
         return make_8bit_rbg_image(width, height, fullwidth, data, clut)
     else:
-        return make_8bit_rbg_image(width, height, width, bpp_iterator(data, width, fullwidth, bpp), clut)
+        return make_8bit_rbg_image(width, height, width, expand_indexes(width, height, fullwidth, data, bpp), clut)
 
-scale_table_31_to_255 = map(lambda v: (v*255)//31 , range(32))
+scale_table_31_to_255 = [(v*255)//31 for v in range(32)]
 
 def make_16bit_rbg_image(width, height, fullwidth, data):
-    color_res = bytearray(3*width*height)
-    pos = 0
-    for y in range(height):
-        row_start = y*fullwidth
-        for x in range(width):
-            pix_start = row_start + x
-            highbits = data[pix_start]
-            lowbits  = data[pix_start + width]
-            bits = (highbits << 8) | lowbits
-            a = bits >> 15
-            r = (bits >> 10) & 31
-            g = (bits >> 5) & 31
-            b = bits & 31
-            if a>0: r=31; g=31; b=0
-            color_res[pos]   = scale_table_31_to_255[r]
-            color_res[pos+1] = scale_table_31_to_255[g]
-            color_res[pos+2] = scale_table_31_to_255[b]
-            pos += 3
-    color_res = str(color_res)
+    color_res = rgb_pixels_16bit(width, height, fullwidth, data)
     return pyglet.image.ImageData(width, height, 'RGB', color_res, -3*width)
 
 def make_16bit_rbg_masked_image(width, height, fullwidth, width2,height2,fullwidth2, data, mask):
-    color_res = bytearray(4*width*height)
-    pos = 0
-    for y in range(height):
-        row_start = y*fullwidth
-        for x in range(width):
-            pix_start = row_start + x
-            highbits = data[pix_start]
-            lowbits  = data[pix_start + width]
-            bits = (highbits << 8) | lowbits
-            a = bits >> 15
-            r = (bits >> 10) & 31
-            g = (bits >> 5) & 31
-            b = bits & 31
-            if a>0: r=31; g=31; b=0
-            color_res[pos]   = scale_table_31_to_255[r]
-            color_res[pos+1] = scale_table_31_to_255[g]
-            color_res[pos+2] = scale_table_31_to_255[b]
-            pos += 4
-
-    for y in range(min(height,height2)):
-        pos = y*4*width
-        row_start = y*fullwidth2
-        for x in range(min(width,width2)):
-            color_res[pos+3] = mask[row_start + x]
-            pos += 4
-
-    color_res = str(color_res)
+    color_res = rgba_pixels_16bit_masked(width, height, fullwidth, width2,height2,fullwidth2, data, mask)
     return pyglet.image.ImageData(width, height, 'RGBA', color_res, -4*width)
 
 def make_32bit_rbg_image(width, height, fullwidth, data):
-    color_res = bytearray(4*width*height)
-    pos = 0
-    for y in range(height):
-        for x in range(width):
-            r = data[y*fullwidth + x]
-            g = data[y*fullwidth + x + width]
-            b = data[y*fullwidth + x + 2*width]
-            a = data[y*fullwidth + x + 3*width]
-            color_res[pos]   = r
-            color_res[pos+1] = g
-            color_res[pos+2] = b
-            color_res[pos+3] = a
-            pos += 4
-    color_res = str(color_res)
+    color_res = rgba_pixels_32bit(width, height, fullwidth, data)
     return pyglet.image.ImageData(width, height, 'RGBA', color_res, -4*width)
 
 def make_32bit_rbg_masked_image(width, height, fullwidth, width2,height2,fullwidth2, data, mask):
-    color_res = bytearray(4*width*height)
-    pos = 0
-    for y in range(height):
-        for x in range(width):
-            r = data[y*fullwidth + x]
-            g = data[y*fullwidth + x + width]
-            b = data[y*fullwidth + x + 2*width]
-            a = data[y*fullwidth + x + 3*width]
-            color_res[pos]   = r
-            color_res[pos+1] = g
-            color_res[pos+2] = b
-            pos += 4
-
-    for y in range(min(height,height2)):
-        pos = y*4*width
-        row_start = y*fullwidth2
-        for x in range(min(width,width2)):
-            color_res[pos+3] = mask[row_start + x] # Or multiply?
-            pos += 4
-
-    color_res = str(color_res)
+    color_res = rgba_pixels_32bit_masked(width, height, fullwidth, width2,height2,fullwidth2, data, mask)
     return pyglet.image.ImageData(width, height, 'RGBA', color_res, -4*width)
 
+#### Pixel conversion:
+
+def palette_planes(clut):
+    """Splits an RGB palette into R, G and B translation tables of 256
+    entries each; missing entries are black."""
+    clut = bytearray(clut[:768])
+    clut += bytearray(768 - len(clut))
+    return (bytes(clut[0::3]), bytes(clut[1::3]), bytes(clut[2::3]))
+
+def rgb_pixels_8bit(width, height, fullwidth, data, clut=clut):
+    """Palette lookup of 8-bit indices."""
+    if numpy != None:
+        indexes = pixel_rows(data, height, fullwidth)[:, :width]
+        palette = numpy.frombuffer(b''.join(palette_planes(clut)), dtype=numpy.uint8).reshape(3, 256)
+        return palette.T.take(indexes, axis=0).tobytes()
+    (rt, gt, bt) = palette_planes(clut)
+    data = bytearray(data)
+    res = bytearray(3*width*height)
+    for y in range(height):
+        row = data[y*fullwidth : y*fullwidth+width]
+        pos = 3*width*y
+        res[pos   : pos+3*width : 3] = row.translate(rt)
+        res[pos+1 : pos+3*width : 3] = row.translate(gt)
+        res[pos+2 : pos+3*width : 3] = row.translate(bt)
+    return bytes(res)
+
+# 5-5-5 components (with the top bit meaning 'show as yellow'),
+# as functions of the high and low byte:
+r555_table = bytes(bytearray(255 if h>=128 else scale_table_31_to_255[(h>>2)&31] for h in range(256)))
+b555_table = bytes(bytearray(scale_table_31_to_255[l&31] for l in range(256)))
+g555_by_high = [(h&3)<<3 for h in range(256)]
+g555_by_low = [l>>5 for l in range(256)]
+
+def rgb_pixels_16bit(width, height, fullwidth, data):
+    """Conversion of 5-5-5 pixels, stored as a plane of high bytes
+    followed by one of low bytes on each row."""
+    if numpy != None:
+        planes = pixel_rows(data, height, fullwidth)[:, :2*width].reshape(height, 2, width)
+        bits = (planes[:, 0].astype(numpy.uint16) << 8) | planes[:, 1]
+        scale = numpy.array(scale_table_31_to_255, dtype=numpy.uint8)
+        res = numpy.empty((height, width, 3), dtype=numpy.uint8)
+        res[:, :, 0] = scale.take((bits >> 10) & 31)
+        res[:, :, 1] = scale.take((bits >> 5) & 31)
+        res[:, :, 2] = scale.take(bits & 31)
+        res[(bits >> 15) > 0] = (255, 255, 0)
+        return res.tobytes()
+    data = bytearray(data)
+    scale = scale_table_31_to_255
+    res = bytearray(3*width*height)
+    for y in range(height):
+        high = data[y*fullwidth : y*fullwidth+width]
+        low = data[y*fullwidth+width : y*fullwidth+2*width]
+        pos = 3*width*y
+        res[pos   : pos+3*width : 3] = high.translate(r555_table)
+        res[pos+1 : pos+3*width : 3] = bytearray(
+            255 if h>=128 else scale[g555_by_high[h] | g555_by_low[l]] for (h,l) in zip(high, low))
+        res[pos+2 : pos+3*width : 3] = bytearray(
+            0 if h>=128 else b for (h,b) in zip(high, low.translate(b555_table)))
+    return bytes(res)
+
+def rgba_pixels_16bit_masked(width, height, fullwidth, width2,height2,fullwidth2, data, mask):
+    rgb = rgb_pixels_16bit(width, height, fullwidth, data)
+    return with_alpha(rgb, 3, width, height, mask, width2, height2, fullwidth2)
+
+def rgba_pixels_32bit(width, height, fullwidth, data):
+    """Interleaving of planar 8-bit R, G, B and A."""
+    if numpy != None:
+        planes = pixel_rows(data, height, fullwidth)[:, :4*width].reshape(height, 4, width)
+        return planes.transpose(0, 2, 1).tobytes()
+    data = bytearray(data)
+    res = bytearray(4*width*height)
+    for y in range(height):
+        pos = 4*width*y
+        for c in range(4):
+            plane_start = y*fullwidth + c*width
+            res[pos+c : pos+4*width : 4] = data[plane_start : plane_start+width]
+    return bytes(res)
+
+def rgba_pixels_32bit_masked(width, height, fullwidth, width2,height2,fullwidth2, data, mask):
+    """Like rgba_pixels_32bit, but with the alpha taken from an 8-bit mask."""
+    if numpy != None:
+        planes = pixel_rows(data, height, fullwidth)[:, :3*width].reshape(height, 3, width)
+        rgb = planes.transpose(0, 2, 1).tobytes()
+    else:
+        data = bytearray(data)
+        rgb = bytearray(3*width*height)
+        for y in range(height):
+            pos = 3*width*y
+            for c in range(3):
+                plane_start = y*fullwidth + c*width
+                rgb[pos+c : pos+3*width : 3] = data[plane_start : plane_start+width]
+    return with_alpha(rgb, 3, width, height, mask, width2, height2, fullwidth2) # Or multiply?
+
+def with_alpha(pixels, channels, width, height, mask, width2, height2, fullwidth2):
+    """Returns the RGB pixels as RGBA, with the alpha taken from an 8-bit
+    mask where it overlaps the image, and 0 elsewhere."""
+    mh = min(height, height2); mw = min(width, width2)
+    if numpy != None:
+        res = numpy.zeros((height, width, 4), dtype=numpy.uint8)
+        res[:, :, :3] = numpy.frombuffer(pixels, dtype=numpy.uint8).reshape(height, width, channels)[:, :, :3]
+        res[:mh, :mw, 3] = pixel_rows(mask, height2, fullwidth2)[:mh, :mw]
+        return res.tobytes()
+    pixels = bytearray(pixels)
+    mask = bytearray(mask)
+    res = bytearray(4*width*height)
+    for y in range(height):
+        pos = 4*width*y; src = channels*width*y
+        for c in range(3):
+            res[pos+c : pos+4*width : 4] = pixels[src+c : src+channels*width : channels]
+        if y < mh:
+            res[pos+3 : pos+4*mw : 4] = mask[y*fullwidth2 : y*fullwidth2+mw]
+    return bytes(res)
+
+# For each depth of 1, 2 or 4 bits: for each of the 8/bpp pixels in a byte
+# (leftmost first), the table from byte value to that pixel's index.
+index_tables = dict((bpp, [bytes(bytearray((c >> (8-bpp*(k+1))) & ((1<<bpp)-1) for c in range(256)))
+                           for k in range(8//bpp)])
+                    for bpp in (1, 2, 4))
+
+def expand_indexes(width, height, fullwidth, data, bpp):
+    """Expands 1, 2 or 4-bit pixels (rows of fullwidth bytes) into 8-bit
+    palette indices (rows of width bytes)."""
+    per_byte = 8 // bpp
+    row_bytes = (width*bpp + 7) // 8
+    data = bytearray(data[:height*fullwidth])
+    data += bytearray(height*fullwidth - len(data))
+    if numpy != None:
+        tables = numpy.frombuffer(b''.join(index_tables[bpp]), dtype=numpy.uint8).reshape(per_byte, 256)
+        packed = pixel_rows(data, height, fullwidth)[:, :row_bytes]
+        return tables.T.take(packed, axis=0).reshape(height, row_bytes*per_byte)[:, :width].tobytes()
+    if fullwidth != row_bytes:
+        data = bytearray().join(data[y*fullwidth : y*fullwidth+row_bytes] for y in range(height))
+    res = bytearray(len(data) * per_byte)
+    for (k, table) in enumerate(index_tables[bpp]):
+        res[k::per_byte] = data.translate(table)
+    expanded_width = row_bytes * per_byte
+    if expanded_width != width:
+        res = bytearray().join(res[y*expanded_width : y*expanded_width+width] for y in range(height))
+    return bytes(res)
+
+def with_opaque_alpha(rgb, width, height):
+    if numpy != None:
+        res = numpy.empty((height, width, 4), dtype=numpy.uint8)
+        res[:, :, :3] = numpy.frombuffer(rgb, dtype=numpy.uint8).reshape(height, width, 3)
+        res[:, :, 3] = 255
+        return res.tobytes()
+    res = bytearray(b'\xff') * (4*width*height)
+    for c in range(3):
+        res[c::4] = rgb[c::3]
+    return bytes(res)
 
+def pixel_rows(data, height, fullwidth):
+    """NumPy view of the data as height rows of fullwidth bytes."""
+    return numpy.frombuffer(data, dtype=numpy.uint8, count=height*fullwidth).reshape(height, fullwidth)
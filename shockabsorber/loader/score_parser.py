@@ -1,12 +1,17 @@
 #### Purpose:
 # Parse score-related sections.
 
+import struct
+from array import array
 from shockabsorber.loader.util import SeqBuffer
-from shockabsorber.model.frames import FrameSequence, FrameDelta, FrameDeltaItem
+from shockabsorber.debug import trace
+from shockabsorber.model.frames import FrameSequence, FrameDelta, FrameDeltaItem, LazyFrameDeltaTable, PackedFrameDeltaTable
+
+tr = trace.get_tracer("score")
 
 def parse_frame_label_section(sections_map, loader_context):
     # Obtain section:
-    vwlb_e = sections_map.entry_by_tag("VWLB")
+    vwlb_e = sections_map.entry_by_tag(b"VWLB")
     if vwlb_e == None: return None
 
     buf = SeqBuffer(vwlb_e.bytes())
@@ -24,26 +29,26 @@ def parse_frame_label_section(sections_map, loader_context):
         label = buf.pread_from_to(base_pos+offset1, base_pos+offset2)
         label_table.append((frame_nr, label))
 
-    print("DB| Frame labels: %s" % label_table)
+    if tr.debug_on: tr.debug("Frame labels: %s", [(nr, bytes(label)) for (nr, label) in label_table])
     return label_table
 
 def parse_score_section(sections_map, loader_context):
     # Obtain section:
-    vwsc_e = sections_map.entry_by_tag("VWSC")
+    vwsc_e = sections_map.entry_by_tag(b"VWSC")
     if vwsc_e == None: return None
 
     # Parse header:
     buf = SeqBuffer(vwsc_e.bytes())
     [totalLength, v1, v2, count1a, count1b, size2] = buf.unpack('>6i')
     # Usually, v1=-3, v2=12, count1b=count1a+1.
-    print("DB| Score section: counts=%s size=%s misc=%s" % ([count1a,count1b],[size2],[v1,v2]))
+    if tr.info_on: tr.info("Score section: counts=%s size=%s misc=%s", [count1a,count1b],[size2],[v1,v2])
 
     # Parse offset table:
     offsets = []
     for i in range(count1b):
         [offset] = buf.unpack('>i')
         offsets.append(offset)
-    print("DB| Score section offsets=%s" % offsets)
+    tr.debug("Score section offsets=%s", offsets)
 
     base = buf.tell()
     def get_entry_bytes(idx):
@@ -51,10 +56,11 @@ def parse_score_section(sections_map, loader_context):
 
     # Parse entry index list:
     #print "DB| Score root primary raw: (len %d) <%s>" % (len(get_entry_bytes(0)), get_entry_bytes(0))
-    print("DB| Score root tertiary raw: <%s>" % get_entry_bytes(2))
-    (sprite_count, sprite_size, frame_table) = parse_score_entry_nr0(get_entry_bytes(0))
+    if tr.dump_on: tr.dump("Score root tertiary raw: <%r>", get_entry_bytes(2).tobytes())
+    (sprite_count, sprite_size, frame_table) = parse_score_entry_nr0(get_entry_bytes(0),
+                                                                     loader_context.packed_score)
     entry_indexes = parse_score_entry_nr1(get_entry_bytes(1))
-    print("DB| Occupied score entries (count=%d): %s" % (len(entry_indexes), entry_indexes))
+    tr.debug("Occupied score entries (count=%d): %s", len(entry_indexes), entry_indexes)
 
     # Parse entries:
     table = []
@@ -68,7 +74,7 @@ def parse_score_section(sections_map, loader_context):
         [starttime,endtime,w3,w4,w5] = primbuf.unpack('>5i')
         [w6,w7,w8,w9,w10,w11,w12] = primbuf.unpack('>HiH4i')
         #print "DB| Score entry #%d@%d primary (len=%d): %s <%s>" % (nr, primary_idx, len(prim), [starttime, endtime, [w3,w4,w5,w6,w7,w8,w9,w10,w11,w12]], primbuf.peek_bytes_left())
-        print("DB| Score entry #%d@%d secondary (len=%d): <%s>" % (nr, primary_idx, len(sec), sec))
+        if tr.dump_on: tr.dump("Score entry #%d@%d secondary (len=%d): <%r>", nr, primary_idx, len(sec), sec.tobytes())
         #print "DB| Score entry #%d@%d tertiary (len=%d): <%s>" % (nr, primary_idx, len(tert), tert)
         # if (i%3)==0 and len(entry)>0:
         #     buf2 = SeqBuffer(entry)
@@ -98,37 +104,87 @@ def parse_frame_script_list(blob):
         scripts.append(((castlib_nr, member_nr), extra))
     return scripts
 
-def parse_score_entry_nr0(blob):
+def parse_score_entry_nr0(blob, packed=False):
     buf = SeqBuffer(blob)
     [actualSize, c2, frameCount, c4, sprite_size, c6, v7] = buf.unpack('>3i4h')
-    print("DB| Score root primary: header=%s" % [actualSize, c2, frameCount, c4, sprite_size, c6, v7])
+    if tr.info_on: tr.info("Score root primary: header=%s", [actualSize, c2, frameCount, c4, sprite_size, c6, v7])
     sprite_count = v7 + 6
-    print("DB| Score root primary: extra=%s" % [c2, c4, c6, v7])
+    if tr.info_on: tr.info("Score root primary: extra=%s", [c2, c4, c6, v7])
     #print "DB | Score root <primary: residue=<%s>" % (buf.buf[actualSize:],)
-    buf = SeqBuffer(blob[buf.tell():actualSize])
+    frame_data = blob[buf.tell():actualSize]
+    if packed:
+        deltas = pack_score_frames(frame_data, frameCount)
+        if tr.debug_on: tr.debug("Score framedata: %s", deltas)
+        return (sprite_count, sprite_size, deltas)
+
+    # Only locate the frames here; their delta items are decoded on demand.
+    (frame_starts, frame_ends) = index_score_frames(frame_data, frameCount)
+    if tr.debug_on: tr.debug("Score framedata: %d frames, %d bytes", frameCount, len(frame_data))
+    def decode_frame(start, end):
+        return parse_frame_delta(frame_data[start:end])
+    deltas = LazyFrameDeltaTable(frame_starts, frame_ends, decode_frame)
+    return (sprite_count, sprite_size, deltas)
 
-    maxOffset = 0
-    totItNr = 0
-    deltas = []
-    for frNr in range(1, frameCount+1):
-        frNr += 1
+def index_score_frames(frame_data, frame_count):
+    """Returns the start and end offsets of the delta items of each frame."""
+    buf = SeqBuffer(frame_data)
+    size = len(buf.buf)
+    frame_starts = []
+    frame_ends = []
+    for frNr in range(frame_count):
         [frameDataLength] = buf.unpack('>H')
-        frBuf = SeqBuffer(buf.readBytes(frameDataLength-2))
-        #print "DB| Score root framedata raw=<%s>" % frBuf.buf
-
-        delta_items = []
-        itNr = 0
-        while not frBuf.at_eof():
-            itNr += 1; totItNr += 1
-            [itemLength,offset] = frBuf.unpack('>HH')
-            if offset > maxOffset: maxOffset = offset
-            s = frBuf.readBytes(itemLength)
-            delta_items.append(FrameDeltaItem(offset,s))
-            #print "DB| Score framedata entry [%d][%d] (len %d): %d/0x%x, <%s>" % (frNr, itNr, itemLength, offset, offset, s)
-        deltas.append(FrameDelta(delta_items))
-    #print "DB| Score framedata = %s" % deltas
-    #print "DB| Score framedata: maxOffset = %d (%d*48) chNr=%d totItNr=%d" % (maxOffset, maxOffset // 48, frNr, totItNr)
-    return (sprite_count, sprite_size, deltas)
+        start = buf.tell()
+        end = min(size, start + frameDataLength-2)
+        frame_starts.append(start)
+        frame_ends.append(end)
+        buf.seek(end)
+    return (frame_starts, frame_ends)
+
+item_header_struct = struct.Struct('>HH')
+
+def pack_score_frames(frame_data, frame_count):
+    """Decodes all frames into a PackedFrameDeltaTable."""
+    data = bytearray()
+    item_offsets = array('I')
+    item_lengths = array('H')
+    item_targets = array('H')
+    frame_first_items = array('I')
+    (frame_starts, frame_ends) = index_score_frames(frame_data, frame_count)
+    for fnr in range(frame_count):
+        frame_first_items.append(len(item_offsets))
+        pos = frame_starts[fnr]
+        end = frame_ends[fnr]
+        while pos < end:
+            if pos + item_header_struct.size > end:
+                raise struct.error("truncated delta item in score frame #%d" % (fnr+1))
+            [itemLength,offset] = item_header_struct.unpack_from(frame_data, pos)
+            pos += item_header_struct.size
+            itemLength = min(itemLength, end-pos)
+            if (len(item_offsets) > frame_first_items[-1] and
+                item_targets[-1] + item_lengths[-1] == offset and
+                item_lengths[-1] + itemLength <= 0xFFFF):
+                # Continues the previous item of the frame, whose bytes
+                # end the data so far: one item, one copy when replayed.
+                item_lengths[-1] += itemLength
+            else:
+                item_offsets.append(len(data))
+                item_lengths.append(itemLength)
+                item_targets.append(offset)
+            data += frame_data[pos:pos+itemLength]
+            pos += itemLength
+    frame_first_items.append(len(item_offsets))
+    return PackedFrameDeltaTable(bytes(data), item_offsets, item_lengths, item_targets,
+                                 frame_first_items)
+
+def parse_frame_delta(blob):
+    frBuf = SeqBuffer(blob)
+    delta_items = []
+    while not frBuf.at_eof():
+        [itemLength,offset] = frBuf.unpack('>HH')
+        s = frBuf.readBytes(itemLength)
+        delta_items.append(FrameDeltaItem(offset,s))
+        #print "DB| Score framedata entry (len %d): %d/0x%x, <%s>" % (itemLength, offset, offset, s)
+    return FrameDelta(delta_items)
 
 # Decode entry #1, which holds the list of used primary entries
 # in order sorted by start-time.
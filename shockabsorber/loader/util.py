@@ -3,7 +3,10 @@
 # Utilities for binary parsing.
 #
 
+import os
 import struct
+import threading
+from shockabsorber.debug import trace
 
 class SeqBuffer:  #------------------------------
     def __init__(self,src, is_little_endian=False):
@@ -69,12 +72,33 @@ class SeqBuffer:  #------------------------------
         return self.offset >= len(self.buf)
 #--------------------------------------------------
 
+_seek_lock = threading.Lock()
+
+def pread(file, offset, size):
+    """Reads size bytes at offset without disturbing the file position,
+    so that several threads can read from the same file object."""
+    if hasattr(os, 'pread'):
+        fd = file.fileno()
+        data = os.pread(fd, size, offset)
+        while len(data) < size:
+            more = os.pread(fd, size-len(data), offset+len(data))
+            if not more: break # EOF
+            data += more
+        return data
+    else:
+        with _seek_lock:
+            pos = file.tell()
+            file.seek(offset)
+            data = file.read(size)
+            file.seek(pos)
+        return data
+
 def rev(s):
      return s[::-1]
 
 def half_expect(actual_value, expected_value, name):
     if actual_value != expected_value:
-        print("Surprised: %s is not %s but %s." % (name, expected_value, actual_value))
+        trace.get_tracer("loader").warn("Surprised: %s is not %s but %s.", name, expected_value, actual_value)
 
 int_struct = struct.Struct('>i')
 double_struct = struct.Struct('>d')
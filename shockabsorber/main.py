@@ -5,6 +5,9 @@ import os.path
 
 from shockabsorber.loader import loader
 from shockabsorber.debug import debug
+from shockabsorber.debug import trace
+
+tr = trace.get_tracer("resolver")
 
 def castlib_resolver(rawpath):
     # TODO: This ought to be based on the Cinf section in candidate files.
@@ -14,7 +17,7 @@ def castlib_resolver(rawpath):
 
     # Adapt to local OS:
     filepath = rawpath.replace(":", os.path.sep)
-    print("DB| castlib_resolver: path=<%s>" % filepath)
+    tr.info("castlib_resolver: path=<%s>", filepath)
 
     # Rebase:
     prefix_to_add = os.environ["SHOCKABSORBER_ROOT"]
@@ -34,12 +37,12 @@ def castlib_resolver(rawpath):
             castlib_file = try_path
             break
         else:
-            print("DB| Cast library file does not exist: %s" % try_path)
+            tr.info("Cast library file does not exist: %s", try_path)
     if castlib_file == None:
         raise Exception("Cast library not found: % s" % filepath)
     else:
-        castlib = loader.load_cast_library(castlib_file)
-        print("DB| Resolved %s to %s" % (filepath, castlib))
+        castlib = loader.load_shared_cast_library(castlib_file)
+        tr.info("Resolved %s to %s", filepath, castlib)
         return castlib
 
 # For now, this is just a test program showing the bitmap images in a file.
@@ -53,3 +56,19 @@ def main():
 #    debug.show_audio(movie)
     debug.print_spritevectors(movie)
 #    debug.show_frames(movie)
+
+# Renders the score of a movie to numbered PNG files:
+#   export_frames.py <movie> <output dir> [first frame [last frame [workers]]]
+def export_main():
+    from shockabsorber.render import export
+    if len(sys.argv) < 3:
+        sys.stderr.write("Usage: %s <movie> <output dir> [first [last [workers]]]\n" % sys.argv[0])
+        sys.exit(2)
+    [filename, out_dir] = sys.argv[1:3]
+    numbers = [int(arg) for arg in sys.argv[3:6]]
+    first = numbers[0] if len(numbers) > 0 else 1
+    last = numbers[1] if len(numbers) > 1 else None
+    workers = numbers[2] if len(numbers) > 2 else None
+    written = export.export_frames(filename, out_dir, first, last, workers,
+                                   resolver=castlib_resolver)
+    print("Wrote %d frames to %s" % (written, out_dir))
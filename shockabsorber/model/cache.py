@@ -0,0 +1,70 @@
+#### Purpose:
+# A size-bounded least-recently-used cache, for data which can be
+# recomputed on demand (section bytes, decoded pixels, ...).
+#
+
+import threading
+from collections import OrderedDict
+
+class LRUCache: #------------------------------
+    """Maps keys to byte-like values, keeping the total size of the
+    values within max_bytes by evicting the least recently used ones.
+
+    size_of gives the size of a value; by default its length.
+    Safe to share between threads.
+    """
+    def __init__(self, max_bytes, size_of=len):
+        self.max_bytes = max_bytes
+        self.size_of = size_of
+        self.current_bytes = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __repr__(self):
+        return "<%s %d/%d bytes, %d entries, hits=%d misses=%d evictions=%d>" % (
+            self.__class__.__name__,
+            self.current_bytes, self.max_bytes, len(self.entries),
+            self.hits, self.misses, self.evictions)
+
+    def get(self, key, count=True):
+        with self.lock:
+            value = self.entries.pop(key, None)
+            if value is None:
+                if count: self.misses += 1
+                return None
+            self.entries[key] = value # Now most recently used.
+            if count: self.hits += 1
+            return value
+
+    def put(self, key, value):
+        if value is None: return
+        size = self.size_of(value)
+        if size > self.max_bytes: return # Would evict everything else.
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None: self.current_bytes -= self.size_of(old)
+            self.entries[key] = value
+            self.current_bytes += size
+            while self.current_bytes > self.max_bytes:
+                (_, evicted) = self.entries.popitem(last=False)
+                self.current_bytes -= self.size_of(evicted)
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.current_bytes = 0
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return float(self.hits) / lookups if lookups else 0.0
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions,
+                'entries': len(self.entries),
+                'bytes': self.current_bytes, 'max_bytes': self.max_bytes}
+#--------------------------------------------------
@@ -1,3 +1,8 @@
+import threading
+from shockabsorber.debug import trace
+
+tr = trace.get_tracer("cast")
+
 class CastLibraryTable: #------------------------------
     def __init__(self, castlibs):
         self.by_nr = {}
@@ -12,12 +17,21 @@ class CastLibraryTable: #------------------------------
 
     def get_cast_library(self, lib_nr):
         if lib_nr not in self.by_nr:
-            print("XXXXX No castlib: #%d" % (lib_nr,))
+            tr.warn("No castlib: #%d", lib_nr)
         return self.by_nr.get(lib_nr)
 
     def get_cast_member(self, lib_nr, member_nr):
         cast_lib = self.get_cast_library(lib_nr)
         return cast_lib.get_cast_member(member_nr) if cast_lib != None else None
+
+    def prefetch(self, member_refs):
+        """Makes sure the given (lib_nr, member_nr) members are parsed."""
+        by_lib = {}
+        for (lib_nr, member_nr) in member_refs:
+            by_lib.setdefault(lib_nr, []).append(member_nr)
+        for lib_nr, member_nrs in by_lib.items():
+            cast_lib = self.by_nr.get(lib_nr)
+            if cast_lib != None: cast_lib.prefetch(member_nrs)
 #--------------------------------------------------
 
 class CastLibrary: #------------------------------
@@ -29,6 +43,7 @@ class CastLibrary: #------------------------------
         self.idx_range = idx_range
         self.self_idx = self_idx
         self.castmember_table = None
+        self.linked_library = None
 
     def __repr__(self):
         return "<CastLibrary #%d name=\"%s\" size=%d>" % (self.nr, self.name,
@@ -41,11 +56,74 @@ class CastLibrary: #------------------------------
     def set_castmember_table(self,table):
         self.castmember_table = table
 
+    def link_to(self, castlib):
+        """Makes this (external) cast library share the members of the
+        given, separately loaded one, and keeps that one alive."""
+        self.linked_library = castlib
+        self.castmember_table = castlib.get_castmember_table()
+
     def get_cast_member(self, member_nr):
         if self.castmember_table == None: return None # TODO: Ensure loaded
         try:
             return self.castmember_table[member_nr-1]
         except IndexError:
-            print("XXXXX No cast member: #%d" % (member_nr,))
+            tr.warn("No cast member: #%d", member_nr)
             return None
+
+    def prefetch(self, member_nrs):
+        table = self.castmember_table
+        if isinstance(table, LazyCastMemberTable):
+            table.prefetch([nr-1 for nr in member_nrs if 0 < nr <= len(table)])
+#--------------------------------------------------
+
+class LazyCastMemberTable: #------------------------------
+    """A cast member table whose members are parsed on first access.
+
+    Given properties:
+    - section_nrs is the list of cast member section numbers, one per
+      slot; 0 means an empty slot.
+
+    - load_member is a function from section number to CastMember.
+    """
+    NOT_LOADED = object()
+
+    def __init__(self, section_nrs, load_member):
+        self.section_nrs = section_nrs
+        self.load_member = load_member
+        self.members = [LazyCastMemberTable.NOT_LOADED] * len(section_nrs)
+        self.lock = threading.Lock()
+
+    def __repr__(self):
+        return "<LazyCastMemberTable size=%d loaded=%d>" % (len(self), self.loaded_count())
+
+    def __len__(self):
+        return len(self.section_nrs)
+
+    def __getitem__(self, idx):
+        if idx < 0: idx += len(self.section_nrs)
+        if not (0 <= idx < len(self.section_nrs)):
+            raise IndexError(idx)
+        member = self.members[idx]
+        if member is LazyCastMemberTable.NOT_LOADED:
+            with self.lock:
+                member = self.members[idx]
+                if member is LazyCastMemberTable.NOT_LOADED:
+                    nr = self.section_nrs[idx]
+                    member = self.load_member(nr) if nr != 0 else None
+                    self.members[idx] = member
+        return member
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
+
+    def is_loaded(self, idx):
+        return self.members[idx] is not LazyCastMemberTable.NOT_LOADED
+
+    def loaded_count(self):
+        return sum(1 for m in self.members if m is not LazyCastMemberTable.NOT_LOADED)
+
+    def prefetch(self, idxs):
+        for idx in idxs:
+            self[idx]
 #--------------------------------------------------
@@ -1,15 +1,21 @@
+from shockabsorber.debug import trace
+
+tr = trace.get_tracer("resolver")
+
 class Movie: #------------------------------
-    def __init__(self, castlibs, frames, scripts):
+    def __init__(self, castlibs, frames, scripts, labels=None, stage_size=None):
         self.castlibs = castlibs
         self.frames = frames
         self.scripts = scripts
+        self.labels = labels # A FrameLabelIndex, or None.
+        self.stage_size = stage_size # (width, height), or None if unknown.
 
     def resolve_cast_libraries(self, resolver):
         for _,cl in self.castlibs.iter_by_nr():
-            print("DB| resolve_cast_libraries: cl=%s" % cl)
+            tr.info("resolve_cast_libraries: cl=%s", cl)
             path = cl.get_path()
             if path != None and not cl.castmember_table_is_set():
-                print("DB| resolve_cast_libraries: cl #%d: path=%s" % (cl.nr, path))
+                tr.info("resolve_cast_libraries: cl #%d: path=%s", cl.nr, path)
                 castlib = resolver(path)
-                cl.set_castmember_table(castlib.get_castmember_table())
+                cl.link_to(castlib)
 #--------------------------------------------------
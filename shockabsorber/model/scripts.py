@@ -2,6 +2,10 @@
 # Script-related data structures
 #
 
+from shockabsorber.debug import trace
+
+tr = trace.get_tracer("script")
+
 class ScriptNames: #------------------------------
     def __init__(self, entries, misc):
         self.entries = entries
@@ -17,6 +21,6 @@ class ScriptNames: #------------------------------
         try:
             return self.entries[idx]
         except IndexError:
-            print("XXXXXXXX wrong script name: %d > %d"%(idx, len(self.entries)))
+            tr.warn("wrong script name: %d > %d", idx, len(self.entries))
             return None
 #--------------------------------------------------
@@ -4,9 +4,34 @@
 # to the sections of a .d*r file.
 #
 
+import threading
+from shockabsorber.model.cache import LRUCache
+
+def normalize_tag(tag):
+    """Returns tag as a byte string, whether it is given as bytes,
+    text, or a memoryview; for use as a lookup key."""
+    if isinstance(tag, memoryview):
+        return tag.tobytes()
+    elif not isinstance(tag, bytes):
+        return tag.encode('latin-1')
+    return tag
+
 class SectionMap: #------------------------------
-    def __init__(self, entries):
+    def __init__(self, entries, cache=None, ids=None):
+        """ids are the section ids of the entries, in the same order;
+        by default the entries' list positions."""
         self.entries = entries
+        if cache != None:
+            for e in entries:
+                if e != None: e.cache = cache
+
+        # Index: tag -> [section ids], in entry order.
+        if ids == None: ids = range(len(entries))
+        ids_by_tag = {}
+        for sid, e in zip(ids, entries):
+            if e == None: continue
+            ids_by_tag.setdefault(normalize_tag(e.tag), []).append(sid)
+        self.ids_by_tag = ids_by_tag
 
     def __repr__(self):
         return repr(self.entries)
@@ -14,11 +39,15 @@ class SectionMap: #------------------------------
     def __getitem__(self,idx):
         return self.entries[idx]
 
+    def section_ids_by_tag(self, tag):
+        return self.ids_by_tag.get(normalize_tag(tag), [])
+
+    def entries_by_tag(self, tag):
+        return [self[sid] for sid in self.section_ids_by_tag(tag)]
+
     def entry_by_tag(self, tag):
-        for e in self.entries:
-            if e.tag == tag:
-                return e
-        return None
+        sids = self.section_ids_by_tag(tag)
+        return self[sids[0]] if sids else None
 
     def kv_iter(self):
         return enumerate(self.entries)
@@ -29,19 +58,55 @@ class Section:  #------------------------------
         self.tag = tag
         self.size = size
         self.the_bytes = None
+        self.cache = None
+        self.lock = threading.Lock()
 
     def __repr__(self):
         return('%s(%s @?+%d)' % (self.__class__.__name__, self.tag,self.size))
 
     def bytes(self):
-        if self.the_bytes==None:
-            self.the_bytes = self.read_bytes()
-        return self.the_bytes
+        # Safe to call from several threads: only one of them reads.
+        cache = self.cache
+        if cache==None:
+            the_bytes = self.the_bytes
+            if the_bytes==None:
+                with self.lock:
+                    if self.the_bytes==None:
+                        self.the_bytes = self.read_bytes()
+                    the_bytes = self.the_bytes
+            return the_bytes
+
+        the_bytes = cache.get(self)
+        if the_bytes==None:
+            with self.lock:
+                # Another thread may have read it in the meantime:
+                the_bytes = cache.get(self, count=False)
+                if the_bytes==None:
+                    the_bytes = self.read_bytes()
+                    cache.put(self, the_bytes)
+        return the_bytes
+
+    def store_bytes(self, the_bytes):
+        """For section types which obtain their bytes ahead of time."""
+        if self.cache==None:
+            self.the_bytes = the_bytes
+        else:
+            self.cache.put(self, the_bytes)
 
     def read_bytes(self):
         raise NotImplementedError()
 #--------------------------------------------------
 
+class LRUSectionCache(LRUCache): #------------------------------
+    """A bounded cache of section bytes, shared by any number of sections
+    (and movies). When the total size exceeds max_bytes, the least
+    recently used sections are evicted; they are read again on demand.
+
+    Pass it to the loader as the 'section_cache' option. Without one,
+    each section keeps its bytes for as long as it lives.
+    """
+#--------------------------------------------------
+
 class AssociationTable: #------------------------------
     def __init__(self):
         self.cast_media_by_owner = {}
@@ -0,0 +1,344 @@
+#### Purpose:
+# Headless rendering of score frames: composites the bitmap sprites of
+# a FrameCursor's current frame into an RGBA frame buffer in memory,
+# without pyglet or OpenGL.
+#
+# With NumPy, sprites are blitted and blended as whole arrays; otherwise
+# row by row, blending only the pixels which are neither fully opaque
+# nor fully transparent.
+#
+# For sequential playback, IncrementalRenderer keeps the previous frame
+# and redraws only the regions of the channels which changed.
+
+import re
+try:
+    import numpy
+except ImportError:
+    numpy = None
+from shockabsorber.loader import rle
+from shockabsorber.loader.image_cache import ImageCache, MATTE_INK
+from shockabsorber.model.frames import rect_intersection, rect_union
+from shockabsorber.debug import trace
+
+tr = trace.get_tracer("render")
+
+BACKGROUND_TRANSPARENT_INK = 36 # All white pixels are transparent.
+DEFAULT_STAGE_SIZE = (640, 480)
+
+class Bitmap: #------------------------------
+    """Decoded RGBA pixels: height rows of width pixels, top row first.
+    opaque tells whether all alpha values are 255."""
+    def __init__(self, width, height, pixels):
+        self.width = width
+        self.height = height
+        self.pixels = pixels
+        self.opaque = bytes(pixels[3::4]) == b'\xff' * (width*height)
+
+    def __repr__(self):
+        return "<Bitmap %dx%d%s>" % (self.width, self.height, " opaque" if self.opaque else "")
+#--------------------------------------------------
+
+class Compositor: #------------------------------
+    """Renders frames of a score into RGBA frame buffers of stage size.
+
+    A frame buffer is a bytearray of RGBA pixels, top row first.
+    Sprites are drawn in channel order, at their position minus the
+    anchor of their cast member, at the member's own size; only bitmap
+    members are drawn.
+    Inks: copy draws the bitmap as it is, mask takes its alpha from the
+    next cast member, matte makes the white surrounding the picture
+    transparent, and background transparent all of its white. Other inks
+    are drawn as copy.
+    The bitmaps come from image_cache, by default one of its own (see
+    bitmap_cache()); palettes are those of the cast members.
+    """
+    def __init__(self, castlibs, stage_size=DEFAULT_STAGE_SIZE,
+                 background=(255,255,255), image_cache=None):
+        self.castlibs = castlibs
+        (self.width, self.height) = stage_size
+        self.background_pixel = bytes(bytearray(background[:3]) + b'\xff')
+        self.blank_frame = memoryview(self.background_pixel * (self.width*self.height))
+        if image_cache == None: image_cache = bitmap_cache(castlibs)
+        self.image_cache = image_cache
+        self.drawn_sprites = 0
+
+    def __repr__(self):
+        return "<Compositor %dx%d drawn_sprites=%d>" % (self.width, self.height, self.drawn_sprites)
+
+    def stage_rect(self):
+        return (0, 0, self.width, self.height)
+
+    def new_frame_buffer(self):
+        return bytearray(self.blank_frame)
+
+    def render(self, cursor, frame_buffer=None):
+        """Renders the cursor's current frame; returns the frame buffer."""
+        if frame_buffer == None:
+            frame_buffer = self.new_frame_buffer()
+            self.draw_layout(frame_buffer, self.sprite_layout(cursor), self.stage_rect())
+        else:
+            self.draw(cursor, frame_buffer)
+        return frame_buffer
+
+    def draw(self, cursor, frame_buffer, clip_rect=None):
+        """Redraws the part of the frame buffer within clip_rect (by
+        default, all of it) from the cursor's current frame."""
+        self.draw_regions(cursor, frame_buffer, [self.stage_rect() if clip_rect == None else clip_rect])
+
+    def draw_regions(self, cursor, frame_buffer, rects):
+        """Redraws the parts of the frame buffer within the rectangles
+        from the cursor's current frame; the frame's sprites are looked
+        up once for all of them."""
+        layout = None
+        for rect in rects:
+            clip = rect_intersection(rect, self.stage_rect())
+            if clip == None: continue
+            if layout == None: layout = self.sprite_layout(cursor)
+            self.fill(frame_buffer, clip)
+            self.draw_layout(frame_buffer, layout, clip)
+
+    def sprite_layout(self, cursor):
+        """The (member_ref, ink, rect) of each sprite drawn in the
+        cursor's current frame, in drawing order."""
+        layout = []
+        sprites = cursor.get_sprite_records()
+        for snr in sprites.occupied_channels():
+            if sprites.interval_ref[snr] <= 0: continue
+            member_ref = (int(sprites.castlib[snr]), int(sprites.member[snr]))
+            rect = self.member_rect(member_ref, (int(sprites.pos_x[snr]), int(sprites.pos_y[snr])))
+            if rect != None: layout.append((member_ref, int(sprites.ink[snr]), rect))
+        return layout
+
+    def draw_layout(self, frame_buffer, layout, clip):
+        for (member_ref, ink, rect) in layout:
+            area = rect_intersection(rect, clip)
+            if area == None: continue
+            bitmap = self.image_cache.get_image(member_ref, ink)
+            if bitmap == None: continue
+            self.blit(frame_buffer, bitmap, rect, area)
+            self.drawn_sprites += 1
+
+    def sprite_rect(self, sprite):
+        """The stage rectangle a Sprite is drawn in, or None if it is not
+        drawn. Suitable as FrameCursor.sprite_rect."""
+        if sprite.interval_ref <= 0: return None
+        return self.member_rect(sprite.member_ref, sprite.get_pos())
+
+    def member_rect(self, member_ref, pos):
+        (libnr, membernr) = member_ref
+        member = self.castlibs.get_cast_member(libnr, membernr)
+        if member == None or member.type != 1: return None
+        (ancX, ancY) = member.castdata.get_anchor()
+        (w, h) = member.castdata.dims
+        (left, top) = (pos[0]-ancX, pos[1]-ancY)
+        return (left, top, left+w, top+h)
+
+    def fill(self, frame_buffer, rect):
+        (left, top, right, bottom) = rect
+        stride = 4*self.width
+        if right-left == self.width: # Whole rows: one slice.
+            frame_buffer[top*stride : bottom*stride] = self.blank_frame[top*stride : bottom*stride]
+            return
+        row = self.background_pixel * (right-left)
+        for y in range(top, bottom):
+            pos = y*stride + 4*left
+            frame_buffer[pos : pos+len(row)] = row
+
+    def blit(self, frame_buffer, bitmap, rect, area):
+        """Draws the part within area of the bitmap placed at rect."""
+        (left, top, right, bottom) = area
+        (sx, sy) = (left-rect[0], top-rect[1])
+        (w, h) = (right-left, bottom-top)
+        if numpy != None:
+            stage = numpy.frombuffer(frame_buffer, dtype=numpy.uint8).reshape(self.height, self.width, 4)
+            src = numpy.frombuffer(bitmap.pixels, dtype=numpy.uint8).reshape(bitmap.height, bitmap.width, 4)
+            dst = stage[top:bottom, left:right]
+            src = src[sy:sy+h, sx:sx+w]
+            if bitmap.opaque:
+                dst[...] = src
+            else:
+                alpha = src[:, :, 3:4].astype(numpy.uint16)
+                dst[:, :, :3] = (src[:, :, :3]*alpha + dst[:, :, :3]*(255-alpha) + 127) // 255
+            return
+        stride = 4*self.width
+        bitmap_stride = 4*bitmap.width
+        for y in range(h):
+            dst = (top+y)*stride + 4*left
+            src = (sy+y)*bitmap_stride + 4*sx
+            row = bitmap.pixels[src : src+4*w]
+            if bitmap.opaque:
+                frame_buffer[dst : dst+4*w] = row
+            else:
+                blend_row(frame_buffer, dst, row)
+#--------------------------------------------------
+
+class IncrementalRenderer: #------------------------------
+    """Plays a score into one frame buffer, redrawing after each move
+    only the regions of the channels which changed, as reported by a
+    change-tracking FrameCursor (i.e. by the frame deltas applied).
+
+    - frame_buffer holds the current frame, rendered.
+    - redrawn_fraction is the fraction of the stage redrawn by the last
+      move; redrawn_pixels and frames_rendered add up over all frames.
+
+    When the changed regions cover more than full_redraw_fraction of the
+    stage, the whole stage is redrawn in one go instead.
+    Playback starts at frame #first_frame, rendered in full.
+    """
+    def __init__(self, compositor, frame_seq, full_redraw_fraction=0.5, first_frame=1):
+        self.compositor = compositor
+        self.full_redraw_fraction = full_redraw_fraction
+        self.cursor = frame_seq.create_cursor(track_changes=True)
+        self.cursor.sprite_rect = compositor.sprite_rect
+        self.cursor.go_to_frame(first_frame)
+        self.frame_buffer = compositor.render(self.cursor)
+        self.stage_area = compositor.width * compositor.height
+        self.redrawn_fraction = 1.0
+        self.redrawn_pixels = self.stage_area
+        self.frames_rendered = 1
+
+    def __repr__(self):
+        return "<IncrementalRenderer frame=%d frames_rendered=%d mean_redrawn_fraction=%.3f>" % (
+            self.get_current_frame_nr(), self.frames_rendered, self.mean_redrawn_fraction())
+
+    def get_current_frame_nr(self):
+        return self.cursor.get_current_frame_nr()
+
+    def go_to_frame(self, where):
+        """Moves to frame #where and brings the frame buffer up to date;
+        returns the regions redrawn."""
+        change = self.cursor.go_to_frame(where)
+        regions = self.dirty_regions(change)
+        area = sum((r[2]-r[0]) * (r[3]-r[1]) for r in regions)
+        if area > self.full_redraw_fraction * self.stage_area:
+            regions = [self.compositor.stage_rect()]
+            area = self.stage_area
+        self.compositor.draw_regions(self.cursor, self.frame_buffer, regions)
+        self.redrawn_fraction = float(area) / self.stage_area
+        self.redrawn_pixels += area
+        self.frames_rendered += 1
+        if tr.debug_on: tr.debug("Frame #%d: %d regions, %.1f%% redrawn",
+                                 where, len(regions), 100*self.redrawn_fraction)
+        return regions
+
+    def dirty_regions(self, change):
+        """The parts of the stage covered by the changed channels, before
+        or after the move, as rectangles which do not overlap."""
+        stage = self.compositor.stage_rect()
+        rects = []
+        for snr in change.channels:
+            for rect in change.rects[snr]:
+                rect = rect_intersection(rect, stage)
+                if rect != None: rects.append(rect)
+        return merge_rects(rects)
+
+    def mean_redrawn_fraction(self):
+        return float(self.redrawn_pixels) / (self.frames_rendered * self.stage_area)
+#--------------------------------------------------
+
+def merge_rects(rects):
+    """Replaces overlapping rectangles by their bounding box, until none
+    overlap."""
+    merged = []
+    for rect in rects:
+        i = 0
+        while i < len(merged):
+            if rect_intersection(rect, merged[i]) != None:
+                rect = rect_union(rect, merged.pop(i))
+                i = 0 # The grown rectangle may now overlap earlier ones.
+            else:
+                i += 1
+        merged.append(rect)
+    return merged
+
+OPAQUE_RUN = re.compile(b'\xff+')
+PARTIAL_ALPHA = re.compile(b'[\x01-\xfe]')
+
+def blend_row(frame_buffer, pos, row):
+    """Draws a row of RGBA pixels over the frame buffer at pos."""
+    alpha = bytes(row[3::4])
+    for m in OPAQUE_RUN.finditer(alpha):
+        (a, b) = m.span()
+        frame_buffer[pos+4*a : pos+4*b] = row[4*a : 4*b]
+    row = bytearray(row)
+    for m in PARTIAL_ALPHA.finditer(alpha):
+        i = 4*m.start()
+        p = pos+i
+        a = row[i+3]
+        for c in range(3):
+            frame_buffer[p+c] = (row[i+c]*a + frame_buffer[p+c]*(255-a) + 127) // 255
+
+def create_compositor(movie, **options):
+    """A Compositor for the movie's cast libraries, at its stage size."""
+    stage_size = movie.stage_size
+    if stage_size == None:
+        tr.info("Stage size unknown; using %dx%d", *DEFAULT_STAGE_SIZE)
+        stage_size = DEFAULT_STAGE_SIZE
+    return Compositor(movie.castlibs, stage_size, **options)
+
+def bitmap_cache(castlibs, max_bytes=64*1024*1024):
+    """An ImageCache of Bitmaps, with the matte and background
+    transparent inks applied."""
+    return ImageCache(castlibs, max_bytes,
+                      make_image=bitmap_from_data,
+                      make_masked_image=masked_bitmap_from_data,
+                      ink_filters={MATTE_INK: matte_bitmap,
+                                   BACKGROUND_TRANSPARENT_INK: background_transparent_bitmap})
+
+def bitmap_from_data(image_data, clut=None):
+    (width, height, _, _, _) = image_data
+    return Bitmap(width, height, rle.rgba_pixels(image_data, clut))
+
+def masked_bitmap_from_data(image_data, mask_data, clut=None):
+    (width, height, _, _, _) = image_data
+    return Bitmap(width, height, rle.rgba_pixels_masked(image_data, mask_data, clut))
+
+def white_mask(pixels, width, height):
+    """1 for each white pixel, 0 for the others."""
+    if numpy != None:
+        rgba = numpy.frombuffer(pixels, dtype=numpy.uint8).reshape(width*height, 4)
+        return bytearray((rgba[:, :3] == 255).all(axis=1).astype(numpy.uint8).tobytes())
+    pixels = bytearray(pixels)
+    return bytearray(int(r == 255 and g == 255 and b == 255)
+                     for (r, g, b) in zip(pixels[0::4], pixels[1::4], pixels[2::4]))
+
+def matte_bitmap(bitmap):
+    """Makes the white pixels connected to the edges transparent, by
+    filling the white area row span by row span from the edges."""
+    (width, height) = (bitmap.width, bitmap.height)
+    white = white_mask(bitmap.pixels, width, height) # Cleared as filled.
+    pixels = bytearray(bitmap.pixels)
+    border = ([(x, 0) for x in range(width)] + [(x, height-1) for x in range(width)] +
+              [(0, y) for y in range(height)] + [(width-1, y) for y in range(height)])
+    seeds = [(x, y) for (x, y) in border if white[y*width+x]]
+    while seeds:
+        (x, y) = seeds.pop()
+        row = y*width
+        if not white[row+x]: continue
+        left = white.rfind(b'\0', row, row+x) + 1
+        if left <= row: left = row
+        right = white.find(b'\0', row+x, row+width)
+        if right < 0: right = row+width
+        white[left:right] = bytearray(right-left)
+        pixels[4*left+3 : 4*right : 4] = bytearray(right-left)
+        # Seed each white span next to this one, above and below:
+        for ny in (y-1, y+1):
+            if not 0 <= ny < height: continue
+            (pos, end) = (left + (ny-y)*width, right + (ny-y)*width)
+            while pos < end:
+                pos = white.find(b'\1', pos, end)
+                if pos < 0: break
+                seeds.append((pos - ny*width, ny))
+                pos = white.find(b'\0', pos, end)
+                if pos < 0: break
+    return Bitmap(width, height, bytes(pixels))
+
+def background_transparent_bitmap(bitmap):
+    """Makes all white pixels transparent."""
+    (width, height) = (bitmap.width, bitmap.height)
+    opacity = white_mask(bitmap.pixels, width, height).translate(b'\xff\x00' + b'\x00'*254)
+    pixels = bytearray(bitmap.pixels)
+    if not bitmap.opaque:
+        opacity = bytearray(a & o for (a, o) in zip(pixels[3::4], opacity))
+    pixels[3::4] = opacity
+    return Bitmap(width, height, bytes(pixels))
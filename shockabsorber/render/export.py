@@ -0,0 +1,90 @@
+#### Purpose:
+# Batch export of score frames to numbered PNG files, in parallel.
+#
+# The frame range is cut into chunks, which a pool of worker processes
+# render: each worker loads the movie once, seeks a cursor of its own to
+# the start of each chunk, and plays on from there with an
+# IncrementalRenderer, writing one PNG per frame.
+
+import os
+import multiprocessing
+from shockabsorber.loader import loader
+from shockabsorber.render.compositor import create_compositor, IncrementalRenderer
+from shockabsorber.render.png_writer import write_png
+from shockabsorber.debug import trace
+
+tr = trace.get_tracer("render")
+
+DEFAULT_PATTERN = "frame%05d.png"
+
+def export_frames(filename, out_dir, first=1, last=None, workers=None,
+                  resolver=None, pattern=DEFAULT_PATTERN, compress_level=6,
+                  chunks_per_worker=4, **load_options):
+    """Renders frames #first..#last (by default, to the end of the score)
+    of the movie file to PNG files in out_dir, named after pattern.
+    workers is the number of processes (by default, one per CPU; 1 renders
+    in this process). resolver, if given, resolves the cast libraries of
+    each worker's movie (see Movie.resolve_cast_libraries).
+    Returns the number of frames written."""
+    if workers == None: workers = multiprocessing.cpu_count()
+    if workers <= 1:
+        movie = loader.load_movie(filename, **load_options)
+        frames = movie.frames
+    else:
+        # Each worker loads the movie; here, only the frame count is needed.
+        frames = loader.load_score(filename)
+    if frames == None:
+        tr.warn("%s has no score; nothing to export", filename)
+        return 0
+    frame_count = frames.frame_count()
+    if last == None: last = frame_count
+    first = max(first, 1)
+    last = min(last, frame_count)
+    if last < first: return 0
+    if not os.path.isdir(out_dir): os.makedirs(out_dir)
+
+    # Enough chunks for the workers to even out; each costs one seek.
+    chunk_size = max(1, -(-(last-first+1) // (workers*chunks_per_worker)))
+    chunks = [(start, min(start+chunk_size-1, last), out_dir, pattern, compress_level)
+              for start in range(first, last+1, chunk_size)]
+    tr.info("Exporting frames %d..%d of %s in %d chunks, %d workers",
+            first, last, filename, len(chunks), workers)
+
+    if workers <= 1:
+        if resolver != None: movie.resolve_cast_libraries(resolver)
+        set_worker_movie(movie)
+        return sum(export_chunk(chunk) for chunk in chunks)
+    pool = multiprocessing.Pool(workers, init_worker, (filename, resolver, load_options))
+    try:
+        written = sum(pool.imap_unordered(export_chunk, chunks))
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    return written
+
+# The movie of this (worker) process, and its compositor.
+worker_state = {}
+
+def init_worker(filename, resolver, load_options):
+    movie = loader.load_movie(filename, **load_options)
+    if resolver != None: movie.resolve_cast_libraries(resolver)
+    set_worker_movie(movie)
+
+def set_worker_movie(movie):
+    worker_state['movie'] = movie
+    worker_state['compositor'] = create_compositor(movie)
+
+def export_chunk(chunk):
+    (first, last, out_dir, pattern, compress_level) = chunk
+    compositor = worker_state['compositor']
+    renderer = IncrementalRenderer(compositor, worker_state['movie'].frames, first_frame=first)
+    for fnr in range(first, last+1):
+        if fnr > first: renderer.go_to_frame(fnr)
+        write_png(os.path.join(out_dir, pattern % fnr), compositor.width, compositor.height,
+                  renderer.frame_buffer, compress_level)
+    tr.debug("Exported frames %d..%d (%.1f%% of the stage redrawn)",
+             first, last, 100*renderer.mean_redrawn_fraction())
+    return last-first+1
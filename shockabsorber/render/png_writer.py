@@ -0,0 +1,34 @@
+#### Purpose:
+# Encoding of RGBA frame buffers as PNG files (8-bit truecolour with
+# alpha, no filtering), with nothing but zlib.
+#
+
+import struct
+import zlib
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+def png_chunk(tag, data):
+    return (struct.pack('>I', len(data)) + tag + data +
+            struct.pack('>I', zlib.crc32(tag + data) & 0xFFFFFFFF))
+
+def png_bytes(width, height, rgba, compress_level=6):
+    """Encodes height rows of width RGBA pixels, top row first, as PNG."""
+    stride = 4*width
+    rgba = memoryview(rgba)
+    scanlines = bytearray((stride+1) * height) # Each row: filter type 0, then the pixels.
+    for y in range(height):
+        pos = y*(stride+1) + 1
+        scanlines[pos : pos+stride] = rgba[y*stride : (y+1)*stride]
+    return b''.join([
+        PNG_SIGNATURE,
+        png_chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 6, 0, 0, 0)),
+        png_chunk(b'IDAT', zlib.compress(bytes(scanlines), compress_level)),
+        png_chunk(b'IEND', b'')])
+
+def write_png(filename, width, height, rgba, compress_level=6):
+    f = open(filename, 'wb')
+    try:
+        f.write(png_bytes(width, height, rgba, compress_level))
+    finally:
+        f.close()